@@ -20,19 +20,25 @@ import sys
 import os
 import datetime
 import crcmod
-import json
+from crcmod.crcmod import _usingExtension as crcmod_using_extension
 import shutil
 import socket
 import struct
 import subprocess
 import traceback
 from time import sleep
-from threading import Thread
+from threading import Thread, Event, Lock
 import numpy as np
 from ldpc_encoder import *
 from radio_wrappers import *
 from queue import Queue
 
+# orjson parses bytes directly and is considerably faster than the stdlib json module.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 class PacketTX(object):
     """ Packet Transmitter Class
 
@@ -62,6 +68,14 @@ class PacketTX(object):
     ssdv_queue = Queue(4096) # Up to 1MB of 256 byte packets
     telemetry_queue = Queue(256) # Keep this queue small. It's up to the user not to over-use this queue.
 
+    # Maximum number of queued SSDV packets handed to the radio in a single write.
+    # Kept small, as newly queued telemetry packets have to wait for the whole batch to be sent.
+    ssdv_batch_size = 4
+
+    # Maximum number of already-received UDP packets read in one pass of the UDP listener,
+    # before they are handled.
+    udp_drain_limit = 64
+
     # Framing parameters
     unique_word = b"\xab\xcd\xef\x01"
     preamble = b"\x55"*16
@@ -76,6 +90,11 @@ class PacketTX(object):
     text_message_count = 0
     image_telem_count = 0
 
+    # Pre-compiled image telemetry packet structures.
+    # The packet ID and counter are packed first, followed by the (cached) callsign field, then the remaining data.
+    image_telem_header_struct = struct.Struct(">BH")
+    image_telem_data_struct = struct.Struct(">BHIBffffffBBBBBBBBBbfffffff")
+
     # WARNING: 115200 baud is ACTUALLY 115386.834 baud, as measured using a freq counter.
     def __init__(self,
         # Radio wrapper, for radio setup and modulation.
@@ -93,10 +112,35 @@ class PacketTX(object):
         self.callsign = callsign.encode('ascii')
         self.fec = fec
 
+        # Cache of callsigns packed into the image telemetry callsign field.
+        self.image_telem_callsigns = {}
+
         self.crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
+        if not crcmod_using_extension:
+            print("WARNING: crcmod C extension not available, using (slow) pure-Python CRC16. Reinstall crcmod with a C compiler available.")
+
+        # Pre-computed frame header and payload padding.
+        self.frame_header = self.preamble + self.unique_word
+        self.payload_padding = b"\x55"*self.payload_length
+
+        # Frame layout offsets, used to build each frame within a single buffer.
+        self.payload_offset = len(self.frame_header)
+        self.crc_offset = self.payload_offset + self.payload_length
+        self.parity_offset = self.crc_offset + 2
+        # 516 parity bits, zero-padded to 65 bytes.
+        self.frame_length_fec = self.parity_offset + 65
 
         self.idle_message = self.frame_packet(self.idle_sequence,fec=fec)
 
+        # Set by the transmit thread once the last queued image packet has been sent,
+        # and cleared whenever image packets are queued.
+        self.image_queue_empty_event = Event()
+        self.image_queue_empty_event.set()
+        # Held while the transmit thread checks for an empty image queue and sets the event, and while
+        # a producer clears the event and queues its first packet, so a newly queued image can't be
+        # missed between the check and the set. Never held across a blocking put of more than one packet.
+        self.image_queue_lock = Lock()
+
         if log_file != None:
             self.log_file = open(log_file,'a')
             print(f"Opened log file {log_file}")
@@ -116,36 +160,64 @@ class PacketTX(object):
 
     def start_tx(self):
         self.transmit_active = True
-        txthread = Thread(target=self.tx_thread)
-        txthread.start()
+        self.txthread = Thread(target=self.tx_thread)
+        self.txthread.start()
+
+    def set_tx_thread_scheduling(self, cpus=None, fifo_priority=None):
+        """ Pin the transmit thread to a set of CPU cores, and/or run it under the SCHED_FIFO
+            real-time scheduling policy, so the modulator is never starved of data.
+            Must be called after start_tx(). Linux only, and SCHED_FIFO requires root (or CAP_SYS_NICE).
+            Returns True if all requested settings were applied.
+        """
+        _tid = self.txthread.native_id
+        try:
+            if cpus is not None:
+                os.sched_setaffinity(_tid, cpus)
+            if fifo_priority is not None:
+                os.sched_setscheduler(_tid, os.SCHED_FIFO, os.sched_param(fifo_priority))
+            return True
+        except (AttributeError, OSError) as e:
+            print("Could not set transmit thread scheduling - %s" % str(e))
+            return False
 
 
 
     def frame_packet(self,packet, fec=False):
+        """ Frame a packet, returning a bytearray containing the preamble, unique word, 
+        payload (clipped/padded to the payload length), checksum, and (optionally) LDPC parity bits.
+
+        The frame is built in-place in a single buffer, with the CRC and LDPC encoder
+        operating on views into that buffer.
+        """
+        if fec:
+            frame = bytearray(self.frame_length_fec)
+        else:
+            frame = bytearray(self.parity_offset)
+
+        frame[:self.payload_offset] = self.frame_header
+
         # Ensure payload size is equal to the desired payload length
-        if len(packet) > self.payload_length:
-            packet = packet[:self.payload_length]
+        _len = min(len(packet), self.payload_length)
+        frame[self.payload_offset:self.payload_offset+_len] = memoryview(packet)[:_len]
+
+        if _len < self.payload_length:
+            frame[self.payload_offset+_len:self.crc_offset] = self.payload_padding[_len:]
 
-        if len(packet) < self.payload_length:
-            packet = packet + b"\x55"*(self.payload_length - len(packet))
+        frame_view = memoryview(frame)
 
-        crc = struct.pack("<H",self.crc16(packet))
+        struct.pack_into("<H", frame, self.crc_offset, self.crc16(frame_view[self.payload_offset:self.crc_offset]))
 
         if fec:
-            parity = ldpc_encode(packet + crc)
-            return self.preamble + self.unique_word + packet + crc + parity
-        else:
-            return self.preamble + self.unique_word + packet + crc 
+            frame[self.parity_offset:] = ldpc_encode(frame_view[self.payload_offset:self.parity_offset])
 
+        frame_view.release()
 
-    def set_idle_message(self, message):
-        temp_msg = b"\x00" + b"DE %s: \t%s" % (self.callsign, message.encode('ascii'))
-        self.idle_message = self.frame_packet(temp_msg,fec=self.fec)
+        return frame
 
 
-    def generate_idle_message(self):
-        # Append a \x00 control code before the data
-        return b"\x00" + b"DE %s: \t%s" % (self.callsign,self.idle_message)
+    def set_idle_message(self, message):
+        # Prepend a \x00 control code and callsign, then frame the result exactly once.
+        self.idle_message = self.frame_packet(b"\x00DE " + self.callsign + b": \t" + message.encode('ascii'), fec=self.fec)
 
 
     def tx_thread(self):
@@ -155,11 +227,20 @@ class PacketTX(object):
         """
         while self.transmit_active:
             if self.telemetry_queue.qsize()>0:
-                packet = self.telemetry_queue.get_nowait()
-                self.radio.transmit_packet(packet)
+                # Send all queued telemetry packets (e.g. the GPS, orientation, image telemetry and
+                # text messages generated together) in a single write.
+                packets = [self.telemetry_queue.get_nowait()]
+                while self.telemetry_queue.qsize()>0:
+                    packets.append(self.telemetry_queue.get_nowait())
+                self.radio.transmit_packets(packets)
             elif self.ssdv_queue.qsize()>0:
-                packet = self.ssdv_queue.get_nowait()
-                self.radio.transmit_packet(packet)
+                packets = [self.ssdv_queue.get_nowait()]
+                while len(packets) < self.ssdv_batch_size and self.ssdv_queue.qsize()>0:
+                    packets.append(self.ssdv_queue.get_nowait())
+                self.radio.transmit_packets(packets)
+                with self.image_queue_lock:
+                    if self.ssdv_queue.qsize() == 0:
+                        self.image_queue_empty_event.set()
             else:
                 self.radio.transmit_packet(self.idle_message)
                 time.sleep(0.1)
@@ -176,7 +257,7 @@ class PacketTX(object):
 
     # Deprecated function
     def tx_packet(self,packet,blocking = False):
-        self.ssdv_queue.put(self.frame_packet(packet, self.fec))
+        self.queue_image_packet(packet)
 
         if blocking:
             while not self.ssdv_queue.empty():
@@ -191,20 +272,46 @@ class PacketTX(object):
     # New packet queueing and queue querying functions (say that 3 times fast)
 
     def queue_image_packet(self,packet):
-        self.ssdv_queue.put(self.frame_packet(packet, self.fec))
+        frame = self.frame_packet(packet, self.fec)
+        with self.image_queue_lock:
+            self.image_queue_empty_event.clear()
+            self.ssdv_queue.put(frame)
 
 
     def queue_image_file(self, filename):
         """ Read in <filename> and transmit it, 256 bytes at a time.
             Intended for transmitting SSDV images.
         """
-        file_size = os.path.getsize(filename)
         try:
-            f = open(filename,'rb')
-            for x in range(file_size//256):
-                data = f.read(256)
-                self.queue_image_packet(data)
-            f.close()
+            with open(filename,'rb') as f:
+                data = f.read()
+                # We won't be reading this file again, so don't let it hold pages in the page cache.
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except:
+            return False
+
+        return self.queue_image_bytes(data)
+
+    def queue_image_bytes(self, data):
+        """ Transmit the SSDV image held in <data> (a bytes-like object), 256 bytes at a time. """
+        try:
+            # Frame all packets up-front, from views into the image data.
+            data_view = memoryview(data)
+            frames = [self.frame_packet(data_view[i:i+256], self.fec) for i in range(0, len(data) - len(data)%256, 256)]
+            data_view.release()
+
+            if len(frames) == 0:
+                return True
+
+            # Clear the event and queue the first packet together. The rest are queued outside the lock,
+            # as the transmit thread takes it after every batch, and would deadlock against a put blocked on a full queue.
+            with self.image_queue_lock:
+                self.image_queue_empty_event.clear()
+                self.ssdv_queue.put(frames[0])
+            for frame in frames[1:]:
+                self.ssdv_queue.put(frame)
+
             return True
         except:
             return False
@@ -212,6 +319,12 @@ class PacketTX(object):
     def image_queue_empty(self):
         return self.ssdv_queue.qsize() == 0
 
+    def wait_image_queue_empty(self, timeout=None):
+        """ Block until the image queue has been fully transmitted, or until timeout (seconds).
+            Returns True if the image queue is empty. """
+        self.image_queue_empty_event.wait(timeout)
+        return self.image_queue_empty()
+
 
     def queue_telemetry_packet(self, packet, repeats = 1):
         for n in range(repeats):
@@ -238,7 +351,7 @@ class PacketTX(object):
 
         """
         # Increment text message counter.
-        self.text_message_count = (self.text_message_count+1)%65536
+        self.text_message_count = (self.text_message_count+1) & 0xFFFF
         # Clip message if required.
         if len(message) > 252:
             message = message[:252]
@@ -407,13 +520,17 @@ class PacketTX(object):
         image_telemetry_decoder
 
         """
-        self.image_telem_count = (self.image_telem_count+1)%65536
+        self.image_telem_count = (self.image_telem_count+1) & 0xFFFF
+
+        # The callsign field is constant for a session, so only pack it once.
+        if callsign not in self.image_telem_callsigns:
+            self.image_telem_callsigns[callsign] = struct.pack(">7p", callsign.encode())
 
         try:
-            image_packet = struct.pack(">BH7pBHIBffffffBBBBBBBBBbfffffff",
+            image_packet = self.image_telem_header_struct.pack(
                 0x54,   # Packet ID for the GPS Telemetry Packet.
-                self.image_telem_count,
-                callsign.encode(),
+                self.image_telem_count
+                ) + self.image_telem_callsigns[callsign] + self.image_telem_data_struct.pack(
                 image_id,
                 gps_data['week'],
                 int(gps_data['iTOW']*1000), # Convert the GPS week value to milliseconds, and cast to an int.
@@ -460,7 +577,7 @@ class PacketTX(object):
         """
 
         # Clip the id to 0-255.
-        _id = int(id) % 256
+        _id = int(id) & 0xFF
 
         # Convert the provided data to a string
         _data = bytes(bytearray(data))
@@ -498,34 +615,43 @@ class PacketTX(object):
     # UDP messaging functions.
     #
 
-    def handle_udp_packet(self, packet):
-        ''' Process a received UDP packet '''
-        try:
-            packet_dict = json.loads(packet.decode())
+    def handle_udp_text_packet(self, packet_dict):
+        """ Transmit an arbitrary text packet. We assume the data is a string. """
+        self.transmit_text_message(packet_dict['packet'])
 
-            if packet_dict['type'] == 'WENET_TX_TEXT':
-                # Transmit an arbitrary text packet.
-                # We assume the data is a string.
-                self.transmit_text_message(packet_dict['packet'])
 
-            elif packet_dict['type'] == 'WENET_TX_SEC_PAYLOAD':
-                # This is a 'secondary' payload packet. It needs to have a 'id' field,
-                # and a 'data' field which contains the packet contents, provided as a *list of integers*.
-                # The user can optionally provide a 'repeats' integer, which defines the number of times
-                # to repeat transmission of the packet.
-                _id = int(packet_dict['id'])
+    def handle_udp_sec_payload_packet(self, packet_dict):
+        """ Transmit a 'secondary' payload packet.
+        It needs to have a 'id' field, and a 'data' field which contains the packet contents,
+        provided as a *list of integers*.
+        The user can optionally provide a 'repeats' integer, which defines the number of times
+        to repeat transmission of the packet.
+        """
+        _id = int(packet_dict['id'])
 
-                if 'repeats' in packet_dict:
-                    _repeats = int(packet_dict['repeats'])
-                else:
-                    _repeats = 1
+        if 'repeats' in packet_dict:
+            _repeats = int(packet_dict['repeats'])
+        else:
+            _repeats = 1
 
+        self.transmit_secondary_payload_packet(id=_id, data=packet_dict['packet'], repeats=_repeats)
 
-                self.transmit_secondary_payload_packet(id=_id, data=packet_dict['packet'], repeats=_repeats)
 
-            else:
-                pass
+    # Lookup of UDP packet type to handler function.
+    udp_packet_handlers = {
+        'WENET_TX_TEXT': handle_udp_text_packet,
+        'WENET_TX_SEC_PAYLOAD': handle_udp_sec_payload_packet
+    }
 
+    def handle_udp_packet(self, packet):
+        ''' Process a received UDP packet '''
+        try:
+            packet_dict = _json.loads(packet)
+
+            _handler = self.udp_packet_handlers.get(packet_dict['type'])
+
+            if _handler:
+                _handler(self, packet_dict)
 
         except Exception as e:
             print("Could not parse packet: %s" % str(e))
@@ -542,20 +668,37 @@ class PacketTX(object):
             self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         except:
             pass
+        # Increase the receive buffer size so we can absorb bursts of packets.
+        try:
+            self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
+        except:
+            pass
         self.udp.bind(('',self.udp_port))
         print("Started UDP Listener Thread.")
         self.udp_listener_running = True
 
         while self.udp_listener_running:
+            packets = []
             try:
                 m = self.udp.recvfrom(4096)
-            except socket.timeout:
-                m = None
+                packets.append(m[0])
+
+                # Drain any other packets which have already arrived, without blocking.
+                # (With a socket timeout set, MSG_DONTWAIT would still wait out the timeout.)
+                self.udp.setblocking(False)
+                try:
+                    while len(packets) < self.udp_drain_limit:
+                        m = self.udp.recvfrom(4096)
+                        packets.append(m[0])
+                finally:
+                    self.udp.settimeout(1)
+            except (socket.timeout, BlockingIOError):
+                pass
             except:
                 traceback.print_exc()
-            
-            if m != None:
-                self.handle_udp_packet(m[0])
+
+            for packet in packets:
+                self.handle_udp_packet(packet)
         
         print("Closing UDP Listener")
         self.udp.close()
@@ -576,17 +719,21 @@ class BinaryDebug(object):
     format for use with codec2-dev's fsk modulator.
     Useful for debugging, that's about it.
     """
+
+    # Output for each possible byte value: a start bit (0), 8 data bits LSB first, then a stop bit (1).
+    FRAMED_BITS = np.hstack((
+        np.zeros((256,1), dtype=np.uint8),
+        np.unpackbits(np.arange(256, dtype=np.uint8)[:,None], axis=1, bitorder='little'),
+        np.ones((256,1), dtype=np.uint8)
+        ))
+
     def __init__(self):
         self.f = open("debug.bin",'wb')
 
     def write(self,data):
-        # TODO: Add in RS232 framing
-        raw_data = np.array([],dtype=np.uint8)
-        for d in data:
-            d_array = np.unpackbits(np.fromstring(d,dtype=np.uint8))
-            raw_data = np.concatenate((raw_data,[0],d_array[::-1],[1]))
-
-        self.f.write(raw_data.astype(np.uint8).tostring())
+        # Look up the framed bits for every byte in one go, and write the array out directly (no bytes copy).
+        raw_data = self.FRAMED_BITS[np.frombuffer(data, dtype=np.uint8)]
+        self.f.write(raw_data)
 
     def close(self):
         self.f.close()
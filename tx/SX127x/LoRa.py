@@ -866,6 +866,15 @@ class LoRaRFM98W(object):
     def set_register(self, register_address, val):
         return self.spi.xfer([register_address | 0x80, val])[1]
 
+    def set_register_burst(self, register_address, vals):
+        """ Write to a run of consecutive registers in a single (burst mode) SPI transfer
+        :param register_address: Address of the first register to write
+        :param vals: Values to write, starting at register_address
+        :return: Previous register contents
+        :rtype: list[int]
+        """
+        return self.spi.xfer([register_address | 0x80] + list(vals))[1:]
+
     def get_all_registers(self):
         # read all registers
         reg = [0] + self.spi.xfer([1]+[0]*0x3E)[1:]
@@ -20,8 +20,8 @@
 # <http://www.gnu.org/licenses/>.
 
 
-import time,thread
-from spibridge import SPIBridge
+import time,threading
+from .spibridge import SPIBridge
 
 
 class HardwareInterface(object):
@@ -30,20 +30,55 @@ class HardwareInterface(object):
         Board initialisation/teardown and pin configuration is kept here.
         Only the DIO0 and DIO5 pins are wired up on these Arduino shields
     """
-    # The  object is kept here
-    spi = None
+    __slots__ = ('spi', 'spi_read_gpio', 'spi_set_led', 'dio_callbacks', 'poll_interval',
+                 'poll_running', 'poll_thread', 'irq_flags', 'gpio_irq_supported', 'blink_thread')
 
-    def __init__(self,port="/dev/ttyUSB0",baud=57600):
+    def __init__(self,port="/dev/ttyUSB0",baud=57600,poll_interval=0.001):
         """ Configure the Raspberry GPIOs
+        :param poll_interval: Delay (seconds) between DIO polls, once callbacks have been registered.
         :rtype : None
         """
         self.spi = SPIBridge(port,baud)
+        # Bound methods for the frequently called bridge commands.
+        self.spi_read_gpio = self.spi.read_gpio
+        self.spi_set_led = self.spi.set_led
+
+        # Every bridge command is a short request/response, so drop the USB-serial
+        # read latency timer (16ms on FTDI adaptors) via ASYNC_LOW_LATENCY.
+        # Requires pyserial >= 3.5 on Linux.
+        try:
+            self.spi.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, IOError, ValueError) as e:
+            print("Could not enable serial low latency mode: %s" % str(e))
+
+        # DIO callbacks, indexed by DIO number. These are serviced by a polling thread,
+        # which is started when the first callback is registered.
+        self.dio_callbacks = [None]*6
+        self.poll_interval = poll_interval
+        self.poll_running = False
+        self.poll_thread = None
+        # RegIrqFlags as of the last DIO poll.
+        self.irq_flags = 0
+        self.blink_thread = None
+
+        # Check whether the bridge firmware supports the combined GPIO/IRQ read. This is decided once,
+        # from the bridge's reply, so a single failed read later on doesn't drop us back to separate reads.
+        self.gpio_irq_supported = self.probe_gpio_irq()
+        if not self.gpio_irq_supported:
+            print("SPI Bridge firmware does not support combined GPIO/IRQ reads, using separate reads.")
 
         # blink 2 times to signal the board is set up
         self.blink(.1, 2)
 
     def teardown(self):
         """ Cleanup Serial Instance """
+        self.poll_running = False
+        if self.poll_thread:
+            self.poll_thread.join()
+            self.poll_thread = None
+        if self.blink_thread:
+            self.blink_thread.join()
+            self.blink_thread = None
         self.spi.close()
 
     def SpiDev(self):
@@ -54,42 +89,118 @@ class HardwareInterface(object):
         return self.spi
 
     def add_event_detect(self,dio_number, callback):
-        """ Wraps around the GPIO.add_event_detect function
+        """ Register a callback for a DIO pin. As we have no interrupt lines, the DIO pins
+            are polled by a background thread, and the callback is run on a rising edge.
         :param dio_number: DIO pin 0...5
         :param callback: The function to call when the DIO triggers an IRQ.
         :return: None
         """
-        pass
+        self.dio_callbacks[dio_number] = callback
+
+        if self.poll_thread is None:
+            self.poll_running = True
+            self.poll_thread = threading.Thread(target=self.poll_loop)
+            self.poll_thread.daemon = True
+            self.poll_thread.start()
 
     def add_events(self,cb_dio0, cb_dio1, cb_dio2, cb_dio3, cb_dio4, cb_dio5, switch_cb=None):
-        pass
+        # Only DIO0 and DIO5 are wired up.
+        self.add_event_detect(0, cb_dio0)
+        self.add_event_detect(5, cb_dio5)
+
+    def poll_loop(self):
+        """ Poll the DIO pins with a single GPIO read per iteration, and dispatch
+            callbacks on any rising edges. """
+        read_gpio_and_irq = self.read_gpio_and_irq
+        callbacks = self.dio_callbacks
+        sleep = time.sleep
+        prev = 0
+        while self.poll_running:
+            (cur, irq) = read_gpio_and_irq()
+            if cur >= 0:
+                self.irq_flags = irq
+                rising = cur & ~prev
+                if rising:
+                    for i in range(6):
+                        if rising & (1<<i) and callbacks[i]:
+                            callbacks[i](i)
+                prev = cur
+            sleep(self.poll_interval)
 
     def led_on(self,value=1):
-        """ Switch the proto shields LED
+        """ Switch the proto shields LED. The command is sent along with the next bridge transaction.
         :param value: 0/1 for off/on. Default is 1.
         :return: value
         :rtype : int
         """
-        self.spi.set_led(1)
+        self.spi_set_led(1)
         return value
 
     def led_off(self):
         """ Switch LED off
         :return: 0
         """
-        self.spi.set_led(0)
+        self.spi_set_led(0)
         return 0
 
     def blink(self,time_sec, n_blink):
+        """ Blink the LED n_blink times, in a background thread so the caller isn't held up. """
+        if n_blink == 0:
+            return
+        self.blink_thread = threading.Thread(target=self.blink_sync, args=(time_sec, n_blink))
+        self.blink_thread.daemon = True
+        self.blink_thread.start()
+
+    def blink_sync(self,time_sec, n_blink):
+        """ Blink the LED n_blink times, returning once done. """
         if n_blink == 0:
             return
-        self.led_on()
+        # Let the bridge firmware do the toggling, in one transaction.
+        if self.spi.blink_pattern(int(time_sec*1000), n_blink):
+            return
+        # Firmware doesn't support the BLINK opcode, fall back to toggling the LED from here.
+        # LED commands are buffered by the bridge, so flush each one out for the timing to hold.
+        set_led = self.spi_set_led
+        flush = self.spi.flush
+        set_led(1)
+        flush()
         for i in range(n_blink):
             time.sleep(time_sec)
-            self.led_off()
+            set_led(0)
+            flush()
             time.sleep(time_sec)
-            self.led_on()
-        self.led_off()
+            set_led(1)
+            flush()
+        set_led(0)
+        flush()
 
     def read_gpio(self):
-        return self.spi.read_gpio()
\ No newline at end of file
+        return self.spi_read_gpio()
+
+    def probe_gpio_irq(self, attempts=3):
+        """ Ask the bridge whether it supports the combined GPIO/IRQ read, retrying if no valid reply
+            is received. Older firmware, which may not reply to unknown commands at all, is assumed
+            if there is still no answer after all attempts.
+        :return: True if supported, otherwise False.
+        """
+        for i in range(attempts):
+            supported = self.spi.probe_gpio_irq()
+            if supported is not None:
+                return supported
+        return False
+
+    def read_gpio_and_irq(self):
+        """ Read the DIO pin state and the SX127x RegIrqFlags register.
+        :return: (gpio_byte, irq_byte), where bit n of gpio_byte is DIOn, or (-1,-1) on failure.
+        """
+        if self.gpio_irq_supported:
+            return self.spi.read_gpio_and_irq()
+
+        # Older firmware - use separate GPIO and register reads.
+        (dio0, dio5) = self.spi_read_gpio()
+        if dio0 < 0:
+            return (-1,-1)
+        irq = self.spi.xfer([0x12, 0])
+        if len(irq) < 2:
+            return (-1,-1)
+        return ((dio0 & 1) | ((dio5 & 1) << 5), irq[1])
\ No newline at end of file
@@ -19,7 +19,37 @@
 # You should have received a copy of the GNU General Public License along with pySX127x.  If not, see
 # <http://www.gnu.org/licenses/>.
 
-import serial, time, struct
+import serial, serial.threaded, time, struct, threading, queue, os, select
+
+
+class BridgeProtocol(serial.threaded.Protocol):
+	""" Splits the incoming serial stream from the bridge into response frames. """
+
+	def __init__(self):
+		self.buffer = bytearray()
+		self.frames = queue.Queue()
+
+	def data_received(self, data):
+		self.buffer.extend(data)
+		while True:
+			# Re-synchronise on the sync word.
+			idx = self.buffer.find(b'\xAB\xCD')
+			if idx < 0:
+				# Keep a trailing partial sync word.
+				del self.buffer[:-1]
+				return
+			if idx > 0:
+				del self.buffer[:idx]
+
+			# Frame = sync (2) + opcode (1) + length (2) + payload + crc (2)
+			if len(self.buffer) < 5:
+				return
+			frame_len = 7 + struct.unpack_from('>H', self.buffer, 3)[0]
+			if len(self.buffer) < frame_len:
+				return
+			self.frames.put(bytes(self.buffer[:frame_len]))
+			del self.buffer[:frame_len]
+
 
 class SPIBridge(object):
 
@@ -31,19 +61,44 @@ class SPIBridge(object):
 	OPCODE_SPI_TXFR    = 0x01
 	OPCODE_LED         = 0x02
 	OPCODE_READ_GPIO   = 0x03
+	OPCODE_BLINK       = 0xB1
+	OPCODE_READ_GPIO_IRQ = 0xC2
 
 	def __init__(self, serialport="/dev/ttyUSB0",serialbaud=57600):
 		self.ser = serial.Serial(serialport, serialbaud, timeout=1)
-		print "Waiting for Arduino to boot..."
+		# Writes go straight to the port's file descriptor where we have one (POSIX).
+		try:
+			self.fd = self.ser.fileno()
+		except (AttributeError, NotImplementedError):
+			self.fd = None
+		# Serialise command/response transactions, which may be issued from multiple threads.
+		self.lock = threading.Lock()
+		self.response_timeout = 1.0
+		# Write-combining buffer for commands whose responses we don't need (e.g. set_led).
+		# These are sent along with the next transaction (or flush), and their responses skipped.
+		self.tx_buffer = bytearray()
+		self.pending_responses = 0
+		# Responses are read and framed by a background reader thread.
+		self.reader = serial.threaded.ReaderThread(self.ser, BridgeProtocol)
+		self.reader.start()
+		(self.transport, self.protocol) = self.reader.connect()
+		print("Waiting for Arduino to boot...")
 		time.sleep(2)
 		if "SPIBridge" in self.read_version():
-			print "Connected OK!"
+			print("Connected OK!")
 		else:
-			print "Could not connect to SPI Bridge."
+			print("Could not connect to SPI Bridge.")
+
 
+	@property
+	def serial(self):
+		""" The underlying pyserial Serial object. """
+		return self.ser
 
 	def close(self):
-		self.ser.close()
+		self.flush()
+		# Stops the reader thread and closes the serial port.
+		self.reader.close()
 
 	# CRC16 Functions
 	crc16tab = [
@@ -82,7 +137,7 @@ class SPIBridge(object):
 	]
 
 	def crc16_floating(self,next_byte, seed):
-	    return ((seed << 8) ^ self.crc16tab[(seed >> 8) ^ (ord(next_byte) & 0x00FF)])\
+	    return ((seed << 8) ^ self.crc16tab[(seed >> 8) ^ (next_byte & 0x00FF)])\
 	        & 0xFFFF
 
 	def crc16_buff(self,buff):
@@ -91,20 +146,68 @@ class SPIBridge(object):
 	        crc = self.crc16_floating(ch, crc)
 	    return crc
 
+	def transact(self, tx_data):
+		""" Send a command frame to the bridge, and wait for its response frame.
+		    Returns an empty string if no response arrives within response_timeout. """
+		frames = self.protocol.frames
+		with self.lock:
+			# Discard any stale responses (e.g. from a previously timed-out command),
+			# as long as we aren't still waiting on responses to flushed commands.
+			if self.pending_responses == 0:
+				while not frames.empty():
+					frames.get_nowait()
+			# Send any buffered commands along with this one.
+			self.tx_buffer += tx_data
+			self.raw_write(self.tx_buffer)
+			del self.tx_buffer[:]
+			try:
+				while True:
+					rx_data = frames.get(timeout=self.response_timeout)
+					if self.pending_responses == 0:
+						return rx_data
+					self.pending_responses -= 1
+			except queue.Empty:
+				self.pending_responses = 0
+				return b''
+
+	def queue_command(self, tx_data):
+		""" Buffer a command frame, to be sent with the next transaction or flush. """
+		with self.lock:
+			self.tx_buffer += tx_data
+			self.pending_responses += 1
+
+	def flush(self):
+		""" Send any buffered command frames now. """
+		with self.lock:
+			if self.tx_buffer:
+				self.raw_write(self.tx_buffer)
+				del self.tx_buffer[:]
+
+	def raw_write(self, data):
+		""" Write data to the serial port, bypassing pyserial's write() where possible. """
+		if self.fd is None:
+			self.ser.write(data)
+			return
+
+		view = memoryview(data)
+		while len(view):
+			try:
+				n = os.write(self.fd, view)
+				view = view[n:]
+			except BlockingIOError:
+				# pyserial opens the port non-blocking - wait until it can take more.
+				select.select([], [self.fd], [])
+		view.release()
+
 	def read_version(self):
 		temp = struct.pack('>BH', self.OPCODE_VERSION, 0x0000)
 		crc = self.crc16_buff(temp)
 		tx_data = struct.pack('>H3sH', self.sync, temp, crc)
 
-		if(self.ser.inWaiting()>0):
-			rx_data = self.ser.read(ser.inWaiting())
-			#print "Data in RX Buffer:" + ':'.join(x.encode('hex') for x in rx_data)
-		# Send!
-		self.ser.write(tx_data)
-		rx_data = self.ser.read(24)
+		rx_data = self.transact(tx_data)
 
-		if(ord(rx_data[2])==self.OPCODE_VERSION):
-			return str(ord(rx_data[5])) + "." + str(ord(rx_data[6])) + "." + str(ord(rx_data[7])) + " " + rx_data[8:-2]
+		if(rx_data[2]==self.OPCODE_VERSION):
+			return str(rx_data[5]) + "." + str(rx_data[6]) + "." + str(rx_data[7]) + " " + rx_data[8:-2].decode('ascii', 'replace')
 		else:
 			return "Unknown"
 
@@ -112,18 +215,12 @@ class SPIBridge(object):
 		if(len(data)>1024):
 			data = data[:1024]
 
-		temp = struct.pack('>BH', self.OPCODE_SPI_TXFR, len(data)) + str(bytearray(data))
+		temp = struct.pack('>BH', self.OPCODE_SPI_TXFR, len(data)) + bytes(bytearray(data))
 		crc = self.crc16_buff(temp)
 		tx_data = struct.pack('>H', self.sync) + temp + struct.pack('>H', crc)
 		#print "Data in TX Buffer:" + ':'.join(x.encode('hex') for x in tx_data)
-		if(self.ser.inWaiting()>0):
-			rx_data = self.ser.read(ser.inWaiting())
-			#print "Data in RX Buffer:" + ':'.join(x.encode('hex') for x in rx_data)
-
-		self.ser.write(tx_data)
-		#time.sleep(1)
-		#print str(self.ser.inWaiting()) + " waiting."
-		rx_data = self.ser.read(len(tx_data))
+
+		rx_data = self.transact(tx_data)
 		#print "SPI RX Data:" + ':'.join(x.encode('hex') for x in rx_data)
 		#print rx_data
 
@@ -134,13 +231,14 @@ class SPIBridge(object):
 		else:
 			#print "Checksum  Fail"
 			pass
-		if(ord(rx_data[2]) == self.OPCODE_SPI_TXFR):
+		if(len(rx_data) > 7 and rx_data[2] == self.OPCODE_SPI_TXFR):
 			return list(bytearray(rx_data[5:-2]))
 		else:
-			print "No Opcode Found!"
+			print("No Opcode Found!")
 			return [0]
 
 	def set_led(self,value=1):
+		""" Set the LED state. The command is buffered until the next transaction or flush. """
 		opcode = self.OPCODE_LED
 		payload_length = 0x0001
 		payload = 0x00
@@ -152,35 +250,67 @@ class SPIBridge(object):
 		crc = self.crc16_buff(temp)
 
 		tx_data = struct.pack('>H4sH', self.sync, temp, crc)
-		if(self.ser.inWaiting()>0):
-			rx_data = self.ser.read(ser.inWaiting())
-			#print "Data in RX Buffer:" + ':'.join(x.encode('hex') for x in rx_data)
-		self.ser.write(tx_data)
 		#print "Data in TX Buffer:" + ':'.join(x.encode('hex') for x in tx_data)
-		rx_data = self.ser.read(len(tx_data))
-		if(rx_data == tx_data):
-			return value
+		self.queue_command(tx_data)
+		return value
 
 	def read_gpio(self):
 		temp = struct.pack('>BH', self.OPCODE_READ_GPIO, 0x0000)
 		crc = self.crc16_buff(temp)
 		tx_data = struct.pack('>H3sH', self.sync, temp, crc)
 
-		if(self.ser.inWaiting()>0):
-			rx_data = self.ser.read(self.ser.inWaiting())
-			#print "Data in RX Buffer:" + ':'.join(x.encode('hex') for x in rx_data)
-		# Send!
-		self.ser.write(tx_data)
 		#print "Data in TX Buffer:" + ':'.join(x.encode('hex') for x in tx_data)
-		rx_data = self.ser.read(9)
+		rx_data = self.transact(tx_data)
 		#print "Data in RX Buffer:" + ':'.join(x.encode('hex') for x in rx_data)
 
-		if(ord(rx_data[2])==self.OPCODE_READ_GPIO):
-			return (ord(rx_data[5]),ord(rx_data[6]))
+		if(len(rx_data) >= 9 and rx_data[2]==self.OPCODE_READ_GPIO):
+			return (rx_data[5],rx_data[6])
 		else:
 			return (-1,-1)
 
+	def read_gpio_and_irq(self):
+		""" Read the DIO pin state and the SX127x RegIrqFlags (0x12) register in one transaction.
+		    Returns (gpio_byte, irq_byte), where bit n of gpio_byte is the state of DIOn,
+		    or (-1,-1) if no valid response was received. """
+		rx_data = self.transact(self.gpio_irq_command())
+
+		if(len(rx_data) == 9 and rx_data[2]==self.OPCODE_READ_GPIO_IRQ):
+			return (rx_data[5],rx_data[6])
+		else:
+			return (-1,-1)
+
+	def probe_gpio_irq(self):
+		""" Check whether the bridge firmware supports the combined GPIO/IRQ read.
+		    Returns True if it answered the command, False if it sent back a valid response to some other
+		    opcode (i.e. it didn't understand the command), or None if no valid response was received
+		    (timeout, CRC error), in which case the result is unknown. """
+		rx_data = self.transact(self.gpio_irq_command())
+
+		if len(rx_data) < 7 or struct.pack('>H', self.crc16_buff(rx_data[2:-2])) != rx_data[-2:]:
+			return None
+		return (len(rx_data) == 9 and rx_data[2]==self.OPCODE_READ_GPIO_IRQ)
+
+	def gpio_irq_command(self):
+		""" Build the combined GPIO/IRQ read command frame. """
+		temp = struct.pack('>BH', self.OPCODE_READ_GPIO_IRQ, 0x0000)
+		crc = self.crc16_buff(temp)
+		return struct.pack('>H3sH', self.sync, temp, crc)
+
+	def blink_pattern(self, period_ms, n_blink):
+		""" Ask the bridge to blink the LED n_blink times, with the on/off timing run on the MCU.
+		    Returns True if the bridge acknowledged the command (by echoing it back), otherwise False,
+		    in which case older firmware without the BLINK opcode is probably in use. """
+		period_ms = max(0, min(int(period_ms), 0xFFFF))
+		n_blink = max(0, min(int(n_blink), 0xFF))
+
+		temp = struct.pack('>BH', self.OPCODE_BLINK, 0x0003) + struct.pack('<BH', n_blink, period_ms)
+		crc = self.crc16_buff(temp)
+		tx_data = struct.pack('>H', self.sync) + temp + struct.pack('>H', crc)
+
+		rx_data = self.transact(tx_data)
+		return rx_data == tx_data
+
 if __name__ == "__main__":
 	spi = SPIBridge()
-	print spi.read_version()
+	print(spi.read_version())
 	spi.close()
\ No newline at end of file
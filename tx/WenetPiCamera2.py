@@ -10,7 +10,7 @@
 #		https://github.com/raspberrypi/picamera2
 #		https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
 
-import glob
+import io
 import os
 import datetime
 import subprocess
@@ -19,8 +19,12 @@ import traceback
 
 from picamera2 import Picamera2
 from libcamera import controls, Transform
+from PIL import Image
+import numpy as np
 from time import sleep
-from threading import Thread
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -58,6 +62,7 @@ class WenetPiCamera2(object):
                 exposure_value = 0.0,
                 use_focus_fom = False,
                 temp_filename_prefix = 'picam_temp',
+                skip_stale_images = False,
                 debug_ptr = None,
                 init_retries = 10,
                 ):
@@ -72,7 +77,7 @@ class WenetPiCamera2(object):
                         NOTE: If you manually specify a transmit resolution, this will resize with NO REGARD FOR ASPECT RATIO - it's up to you to get that right.
 
             num_images: Number of images to capture in sequence when the 'capture' function is called.
-                        The 'best' (largest filesize) image is selected and saved.
+                        The 'best' (sharpest) image is selected and saved.
             image_delay: Delay time (seconds) between each captured image.
 
             vertical_flip: Flip captured images vertically.
@@ -90,8 +95,11 @@ class WenetPiCamera2(object):
                         If not provided, the default windowing (approx centre third of width/height) will be used.
             af_offset:  Offset the lens by a fixed dioptre. May help with autofocus during flights.
             exposure_value: Add a exposure compensation. Defaults to 0.
-            use_focus_fom: Set to True to use FocusFoM data to select the best image instead of file size.
-            temp_filename_prefix: prefix used for temporary files.
+            use_focus_fom: Set to True to use FocusFoM data to select the best image instead of a sharpness score.
+            temp_filename_prefix: prefix used for temporary files. (Unused - candidate images are now held in memory.)
+            skip_stale_images: If True, keep capturing while post-processing is behind, and skip the oldest
+                        waiting image so the freshest capture is sent. Skipped images are still kept on storage.
+                        If False (default), capturing waits until post-processing catches up.
 
             debug_ptr:	'pointer' to a function which can handle debug messages.
                         This function needs to be able to accept a string.
@@ -112,8 +120,13 @@ class WenetPiCamera2(object):
         self.af_offset = af_offset
         self.exposure_value = exposure_value
         self.use_focus_fom = use_focus_fom
+        self.skip_stale_images = skip_stale_images
         self.af_window_rectangle = None # Calculated during init
         self.autofocus_mode = False
+        # Size of the low-res stream used to score image sharpness.
+        self.lores_size = (320, 240)
+        # Maximum time (seconds) to allow the ssdv converter to run.
+        self.ssdv_timeout = 180
 
         # Camera metadata capture, so we can poll for camera stats regularly
         self.capture_in_progress = True
@@ -125,6 +138,22 @@ class WenetPiCamera2(object):
             self.whitebalance = self.wb_lookup['auto']
 
 
+        # Camera tuning data with the lens offset applied. Loaded on first camera initialisation.
+        self.tuning = None
+
+        # Stopping the camera after a capture is handed off to a worker thread, so the caller can get on
+        # with processing the image. Anything that next uses the camera must wait for it via wait_for_stop().
+        self.stop_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_stop = None
+
+        # Set while a capture session (see open_session) is keeping the camera running between captures.
+        self.session_open = False
+
+        # Set to request that auto-capture stops. Waiting on this (rather than sleeping) lets
+        # delays within the auto-capture threads be cut short by stop().
+        self.auto_capture_stop = Event()
+        self.auto_capture_stop.set()
+
         # If we startup too early, the camera is sometimes not available to us.
         # Try and initialise for a while with breaks in between until we can talk to it...
         while init_retries > 0:
@@ -142,6 +171,7 @@ class WenetPiCamera2(object):
 
         # Shutdown any previous instances of the camera object.
         # If we don't do this, we can end up with all sorts of fun errors.
+        self.wait_for_stop()
         try:
             self.cam.close()
             self.debug_message("Closed broken instance of Picamera2")
@@ -149,26 +179,12 @@ class WenetPiCamera2(object):
             pass
 
         # Apply a lens offset if we have been provided one.
+        # The tuning data is only loaded and modified once, and re-used on every camera re-initialisation.
         if self.af_offset != 0:
-            tuning = Picamera2.load_tuning_file("imx708.json")
-            map = Picamera2.find_tuning_algo(tuning, "rpi.af")["map"]
-            self.debug_message(f"Default Focus Mapping: {map}")
-
-            if self.af_offset == -99:
-                # Custom map for testing the full extents of the lens range.
-                map[0] = 0.0
-                map[1] = 0.0
-                map[2] = 15.0
-                map[3] = 1023.0
-            else:
-                # Otherwise, apply an offset
-                offset_hw = self.af_offset * (map[3]-map[1])/(map[2]-map[0])
-                for i in range(1, len(map), 2):
-                    map[i] += offset_hw
-            
-            self.debug_message(f"Modified Focus Mapping: {Picamera2.find_tuning_algo(tuning, 'rpi.af')['map']}")
+            if self.tuning is None:
+                self.tuning = self.load_tuning()
 
-            self.cam = Picamera2(0, tuning=tuning)
+            self.cam = Picamera2(0, tuning=self.tuning)
         
         else:
             self.cam = Picamera2()
@@ -208,7 +224,16 @@ class WenetPiCamera2(object):
             self.debug_message(f"Transmit Resolution set to {str(self.tx_resolution)}, scaled {self.tx_resolution_init} from native.")
 
         # Configure camera, including flip settings.
+        # A YUV420 main stream moves half the data of the default RGB format, and can be
+        # JPEG-encoded directly without a colour-space conversion.
+        # A small low-res stream is also produced, which is used to score the sharpness of each frame.
         capture_config = self.cam.create_still_configuration(
+            main={"size": self.camera_properties['PixelArraySize'], "format": "YUV420"},
+            lores={"size": self.lores_size, "format": "YUV420"},
+            # Three buffers lets capture() hold on to the best frame so far while the camera keeps streaming,
+            # and absorbs frame-to-frame jitter. These are allocated once, at configure time, from CMA -
+            # on a Pi Zero 2 with a high resolution sensor, setting cma=128M in /boot/cmdline.txt may be required.
+            buffer_count=3,
             transform=Transform(hflip=self.horizontal_flip, vflip=self.vertical_flip)
         )
         self.cam.configure(capture_config)
@@ -218,13 +243,19 @@ class WenetPiCamera2(object):
         self.cam.set_controls(
             {'AwbMode': self.whitebalance,
             'AeMeteringMode': controls.AeMeteringModeEnum.Matrix,
-            'ExposureValue': self.exposure_value
-            #'NoiseReductionMode': controls.draft.NoiseReductionModeEnum.Off
+            'ExposureValue': self.exposure_value,
+            'NoiseReductionMode': controls.draft.NoiseReductionModeEnum.Minimal
             }
             )
 
+        # Work out how the camera needs to be driven. These don't change until the camera is re-initialised.
+        # Only the Pi Camera 3 has a controllable lens.
+        self.has_lens_position = 'LensPosition' in self.cam.camera_controls
+        # Without continuous autofocus, the camera is only started when capturing.
+        self.start_stop_per_capture = (not self.has_lens_position) or self.lens_position>=0.0
+
         # Set Pi Camera 3 lens position
-        if 'LensPosition' in self.cam.camera_controls:
+        if self.has_lens_position:
             if self.lens_position>=0.0:
                 self.debug_ptr("Configured lens position to " + str(self.lens_position))
                 self.cam.set_controls({"AfMode": controls.AfModeEnum.Manual, "LensPosition": self.lens_position})
@@ -237,7 +268,7 @@ class WenetPiCamera2(object):
 
 
         # In autofocus mode, we need to start the camera now, so it can start figuring out its focus.
-        if 'LensPosition' in self.cam.camera_controls and self.lens_position<0.0:
+        if not self.start_stop_per_capture:
             self.debug_message("Enabling camera for image capture")
             self.cam.start()
             self.capture_in_progress = False
@@ -247,6 +278,28 @@ class WenetPiCamera2(object):
         # This may help deal with crashes after the camera is running for a long time, and also
         # may help decrease CPU usage a little.
 
+    def load_tuning(self):
+        """ Load the IMX708 camera tuning data, and apply the lens offset to its autofocus mapping. """
+        tuning = Picamera2.load_tuning_file("imx708.json")
+        map = Picamera2.find_tuning_algo(tuning, "rpi.af")["map"]
+        self.debug_message(f"Default Focus Mapping: {map}")
+
+        if self.af_offset == -99:
+            # Custom map for testing the full extents of the lens range.
+            map[0] = 0.0
+            map[1] = 0.0
+            map[2] = 15.0
+            map[3] = 1023.0
+        else:
+            # Otherwise, apply an offset
+            offset_hw = self.af_offset * (map[3]-map[1])/(map[2]-map[0])
+            for i in range(1, len(map), 2):
+                map[i] += offset_hw
+        
+        self.debug_message(f"Modified Focus Mapping: {Picamera2.find_tuning_algo(tuning, 'rpi.af')['map']}")
+
+        return tuning
+
     def debug_message(self, message):
         """ Write a debug message.
         If debug_ptr was set to a function during init, this will
@@ -260,7 +313,47 @@ class WenetPiCamera2(object):
         else:
             print(message)
 
+    def open_session(self):
+        """ Start the camera and keep it running across multiple calls to capture(),
+        rather than starting and stopping it for each capture. Used by auto_capture.
+        Returns True if the session was opened.
+        """
+        self.wait_for_stop()
+        if self.start_stop_per_capture:
+            try:
+                self.debug_message("Enabling camera for capture session")
+                self.cam.start()
+                self.capture_in_progress = False
+            except Exception as e:
+                self.debug_message("Could not enable camera! - " + str(e))
+                return False
+            self.wait_for_convergence()
+
+        self.session_open = True
+        return True
+
+    def close_session(self):
+        """ End a capture session, stopping the camera if it is normally only run when capturing. """
+        if self.session_open and self.start_stop_per_capture:
+            self.debug_message("Disabling camera.")
+            self.capture_in_progress = True
+            try:
+                self.cam.stop()
+            except Exception as e:
+                self.debug_message("Stopping camera object failed - " + str(e))
+        self.session_open = False
+
+    def wait_for_stop(self):
+        """ Wait for any background camera stop to complete. """
+        if self.pending_stop:
+            try:
+                self.pending_stop.result()
+            except Exception as e:
+                self.debug_message("Stopping camera object failed - " + str(e))
+            self.pending_stop = None
+
     def close(self):
+        self.wait_for_stop()
         try:
             self.cam.stop()
         except:
@@ -277,21 +370,16 @@ class WenetPiCamera2(object):
             filename:	destination filename.
         """
 
+        # Make sure the camera has finished stopping from the last capture.
+        self.wait_for_stop()
+
         # Ensure JPG quality is set as required.
         self.cam.options['quality'] = quality
 
-        # Set other settings, White Balance, exposure metering, etc.
-        # TODO - Maybe expose some of these settings?
-        self.cam.set_controls(
-            {'AwbMode': self.whitebalance,
-            'AeMeteringMode': controls.AeMeteringModeEnum.Matrix,
-            'ExposureValue': self.exposure_value
-            #'NoiseReductionMode': controls.draft.NoiseReductionModeEnum.Off
-            }
-            )
+        # White Balance, exposure metering, etc. were set in init_camera, and persist across captures.
 
         # Set Pi Camera 3 lens position, or ensure we are in continuous autofocus mode.
-        if 'LensPosition' in self.cam.camera_controls:
+        if self.has_lens_position:
             if self.lens_position>=0.0:
                 self.debug_ptr("Configured lens position to " + str(self.lens_position))
                 self.cam.set_controls({"AfMode": controls.AfModeEnum.Manual, "LensPosition": self.lens_position})
@@ -302,9 +390,9 @@ class WenetPiCamera2(object):
                     print("Set AfWindows")
                     self.cam.set_controls({"AfWindows": [self.af_window_rectangle]})
 
-        # If we're not using autofocus, then camera would not have been started yet.
-        # Start it now.
-        if 'LensPosition' not in self.cam.camera_controls or self.lens_position>=0.0:
+        # If we're not using autofocus, then camera would not have been started yet,
+        # unless a capture session is open. Start it now.
+        if self.start_stop_per_capture and not self.session_open:
             try:
                 self.debug_message("Enabling camera for image capture")
                 self.cam.start()
@@ -314,9 +402,16 @@ class WenetPiCamera2(object):
                 sleep(1)
                 return False
 
-        sleep(3)
+        # Give the AE/AWB algorithms a chance to settle. In a session, the camera has been running since
+        # the session was opened, so they will already be tracking the scene.
+        if not self.session_open:
+            self.wait_for_convergence()
 
         # Attempt to capture a set of images.
+        # Each frame is scored as it arrives (by FocusFoM, or by the sharpness of its low-res stream),
+        # and only the best frame is held on to and JPEG-encoded.
+        best_request = None
+        img_scores = []
         img_metadata = []
         focus_fom = []
         for i in range(self.num_images):
@@ -325,49 +420,62 @@ class WenetPiCamera2(object):
 
             try:
                 self.capture_in_progress = True
-                # Capture image
-                metadata = self.cam.capture_file("%s_%d.jpg" % (self.temp_filename_prefix,i))
+                # Capture frame
+                request = self.cam.capture_request()
+                metadata = request.get_metadata()
                 # Save metadata for this frame 
-                img_metadata.append(metadata.copy())
+                img_metadata.append(metadata)
                 # Separately store the focus FoM so we can look for the max easily.
                 if 'FocusFoM' in metadata:
                     focus_fom.append(metadata['FocusFoM'])
-                
+
+                if self.use_focus_fom and 'FocusFoM' in metadata:
+                    _score = metadata['FocusFoM']
+                else:
+                    # Y plane of the low-res YUV420 stream, without the row stride padding.
+                    _score = self.focus_score(request.make_array("lores")[:self.lores_size[1], :self.lores_size[0]])
+                img_scores.append(_score)
+
+                # Keep only the best frame so far.
+                if best_request is None or _score > img_scores[_best_pic_idx]:
+                    if best_request:
+                        best_request.release()
+                    best_request = request
+                    _best_pic_idx = i
+                else:
+                    request.release()
+
                 self.capture_in_progress = False
                 print(f"Image captured: {time.time()}")
                 if self.image_delay > 0:
                     sleep(self.image_delay)
             except Exception as e: # TODO: Narrow this down...
                 self.debug_message("Capture Error: %s" % str(e))
+                if best_request:
+                    best_request.release()
                 # Immediately return false. Not much point continuing to try and capture images.
                 return False
+
+        # Encode the best frame to JPEG, before its buffer is returned to the camera.
+        jpeg_buffer = io.BytesIO()
+        try:
+            best_request.save("main", jpeg_buffer, format='jpeg')
+        except Exception as e:
+            self.debug_message("JPEG Encode Error: %s" % str(e))
+            return False
+        finally:
+            best_request.release()
         
-        if 'LensPosition' not in self.cam.camera_controls or self.lens_position>=0.0:
+        if self.start_stop_per_capture and not self.session_open:
             self.debug_message("Disabling camera.")
             self.capture_in_progress = True
-            self.cam.stop()
+            # Stop the camera in the background, it's not needed again until the next capture.
+            self.pending_stop = self.stop_executor.submit(self.cam.stop)
 
         if len(focus_fom)>0:
             self.debug_message(f"Focus FoM Values: {str(focus_fom)}")
-
-        # Otherwise, continue to pick the 'best' image based on filesize.
-        self.debug_message("Choosing Best Image.")
-
-        if self.use_focus_fom and len(focus_fom) > 0:
-            # Use FocusFoM data to pick the best image.
-            _best_pic_idx = focus_fom.index(max(focus_fom))
-            best_pic = "%s_%d.jpg" % (self.temp_filename_prefix,_best_pic_idx)
-            
-        else:
-            # Otherwise use the filesize of the resultant JPEG files.
-            # Bigger JPEG = Sharper image
-            pic_list = glob.glob("%s_*.jpg" % self.temp_filename_prefix)
-            pic_sizes = []
-            # Iterate through list of images and get the file sizes.
-            for pic in pic_list:
-                pic_sizes.append(os.path.getsize(pic))
-            _best_pic_idx = pic_sizes.index(max(pic_sizes))
-            best_pic = pic_list[_best_pic_idx]
+        if not self.use_focus_fom:
+            self.debug_message(f"Sharpness Scores: {str([round(x, 1) for x in img_scores])}")
 
         # Report the image pick results.
         if 'LensPosition' in img_metadata[_best_pic_idx]:
@@ -378,23 +486,53 @@ class WenetPiCamera2(object):
         else:
             self.debug_message(f"Best Image was #{_best_pic_idx}")
 
-        # Copy best image to target filename.
-        self.debug_message("Copying image to storage with filename %s" % filename)
-        os.system("cp %s %s" % (best_pic, filename))
-
-        # Clean up temporary images.
-        os.system("rm %s_*.jpg" % self.temp_filename_prefix)
+        # Write best image to target filename.
+        self.debug_message("Saving image to storage with filename %s" % filename)
+        with open(filename, 'wb') as f:
+            f.write(jpeg_buffer.getbuffer())
 
         return True 
 
+    def focus_score(self, y_plane):
+        """ Estimate the sharpness of an image from its luminance (Y) plane,
+        as the variance of its Laplacian. Higher = sharper.
+        """
+        y = y_plane.astype(np.int16)
+        laplacian = y[:-2,1:-1] + y[2:,1:-1] + y[1:-1,:-2] + y[1:-1,2:] - 4*y[1:-1,1:-1]
+        return float(laplacian.var())
+
+    def wait_for_convergence(self, timeout=3.0, gain_tolerance=0.01):
+        """ Wait until the camera's auto-exposure has locked and the AWB colour gains have
+        stopped moving (across two consecutive frames), or until timeout seconds have passed.
+        """
+        _start = time.time()
+        _prev_gains = None
+        while (time.time() - _start) < timeout:
+            try:
+                metadata = self.cam.capture_metadata()
+            except Exception as e:
+                self.debug_message("Error reading metadata while waiting for AE/AWB - %s" % str(e))
+                sleep(max(0, timeout - (time.time() - _start)))
+                return
+
+            _gains = metadata.get('ColourGains', (0.0, 0.0))
+            if metadata.get('AeLocked', False) and _prev_gains is not None \
+                and abs(_gains[0] - _prev_gains[0]) < gain_tolerance \
+                and abs(_gains[1] - _prev_gains[1]) < gain_tolerance:
+                self.debug_message(f"AE/AWB settled after {time.time() - _start:.2f} seconds.")
+                return
+            _prev_gains = _gains
+
+        self.debug_message("Timed out waiting for AE/AWB to settle.")
+
     def ssdvify(self, filename="output.jpg", image_id=0, quality=6):
         """ Convert a supplied JPEG image to SSDV.
-        Returns the filename of the converted SSDV image.
+        Returns the SSDV image data (bytes), or None if the conversion failed.
 
         Keyword Arguments:
         filename:	Source JPEG filename.
-                    Output SSDV image will be saved to to a temporary file (webcam_temp.jpg) which should be
-                    transmitted immediately.
+                    The image is resized and converted in memory, and the resulting SSDV data
+                    should be transmitted immediately.
         image_id:	Image ID number. Must be incremented between images.
         quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
                     6 provides good quality at decent file-sizes.
@@ -404,32 +542,48 @@ class WenetPiCamera2(object):
         # Wrap image ID field if it's >255.
         image_id = image_id % 256
 
-        # Resize image to the desired resolution.
-        self.debug_message("Resizing image.")
-        return_code = os.system("timeout -k 5 180 convert %s -scale %dx%d\! picam_temp.jpg" % (filename, self.tx_resolution[0], self.tx_resolution[1]))
-        if return_code != 0:
-            self.debug_message("Resize operation failed! (Possible kernel Oops? Maybe set arm_freq to 700 MHz)")
-            return "FAIL"
-
-        # Get non-extension part of filename.
-        file_basename = filename[:-4]
+        # Resize image to the desired resolution, encoding the result into memory.
+        try:
+            # Opening the image only reads its header, so we can cheaply check its size first.
+            with Image.open(filename) as img:
+                if img.size == tuple(self.tx_resolution):
+                    # Already at the transmit resolution - use the JPEG as-is.
+                    with open(filename, 'rb') as f:
+                        jpeg_data = f.read()
+                else:
+                    self.debug_message("Resizing image.")
+                    # Let the JPEG decoder do as much of the downscaling as it can (in the DCT domain).
+                    img.draft('RGB', self.tx_resolution)
+                    jpeg_buffer = io.BytesIO()
+                    img.resize(self.tx_resolution, Image.BILINEAR).save(jpeg_buffer, 'JPEG', quality=90)
+                    jpeg_data = jpeg_buffer.getvalue()
+        except Exception as e:
+            self.debug_message("Resize operation failed! - %s" % str(e))
+            return None
 
-        # Construct SSDV command-line.
-        ssdv_command = "ssdv -e -n -q %d -c %s -i %d picam_temp.jpg picam_temp.ssdv" % (quality, self.callsign, image_id)
-        print(ssdv_command)
+        # Construct SSDV command-line. With no filenames given, ssdv reads the JPEG
+        # from stdin and writes the SSDV data to stdout.
+        ssdv_command = ["ssdv", "-e", "-n", "-q", str(quality), "-c", self.callsign, "-i", str(image_id)]
+        print(" ".join(ssdv_command))
         # Update debug message.
         self.debug_message("Converting image to SSDV.")
 
-        # Run SSDV converter.
-        return_code = os.system(ssdv_command)
+        # Run SSDV converter directly (no shell), killing it if it hangs.
+        try:
+            result = subprocess.run(ssdv_command, input=jpeg_data, stdout=subprocess.PIPE, timeout=self.ssdv_timeout)
+        except subprocess.TimeoutExpired:
+            self.debug_message("ERROR: SSDV conversion timed out.")
+            return None
+        except Exception as e:
+            self.debug_message("ERROR: Could not run SSDV converter - %s" % str(e))
+            return None
 
-        if return_code != 0:
+        if result.returncode != 0 or len(result.stdout) == 0:
             self.debug_message("ERROR: Could not perform SSDV Conversion.")
-            return "FAIL"
+            return None
         else:
-            return "picam_temp.ssdv"
+            return result.stdout
 
-    auto_capture_running = False
     def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
         """ Automatically capture and transmit images in a loop.
         Images are automatically saved to a supplied directory, with file-names
@@ -438,7 +592,7 @@ class WenetPiCamera2(object):
         Use the run() and stop() functions to start/stop this running.
         
         Keyword Arguments:
-        destination_directory:	Folder to save images to. Both raw JPEG and SSDV images are saved here.
+        destination_directory:	Folder to save images to. Raw JPEG images are saved here.
         tx:		A reference to a PacketTX Object, which is used to transmit packets, and interrogate the TX queue.
         post_process_ptr: An optional function which is called after the image is captured. This function
                           will be passed the path/filename of the captured image.
@@ -447,13 +601,28 @@ class WenetPiCamera2(object):
         delay:	An optional delay in seconds between capturing images. Defaults to 0.
                 This delay is added on top of any delays caused while waiting for the transmit queue to empty.
         start_id: Starting image ID. Defaults to 0.
+
+        Capture, post-processing/SSDV conversion, and transmission run as a pipeline of three threads,
+        so the camera can capture the next image while the previous one is being converted and sent.
         """
 
-        image_id = start_id
+        # Stages are linked by small bounded queues, so at most a couple of images are in flight
+        # between each stage.
+        capture_queue = Queue(maxsize=2)
+        transmit_queue = Queue(maxsize=2)
+
+        process_thread = Thread(target=self.process_images, args=(capture_queue, transmit_queue, post_process_ptr, start_id))
+        transmit_thread = Thread(target=self.transmit_images, args=(transmit_queue, tx))
+        process_thread.start()
+        transmit_thread.start()
 
-        while self.auto_capture_running:
+        # Keep the camera running for the whole session.
+        self.open_session()
+
+        while not self.auto_capture_stop.is_set():
             # Sleep before capturing next image.
-            sleep(delay)
+            if self.auto_capture_stop.wait(delay):
+                break
 
             # Grab current timestamp.
             capture_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
@@ -473,6 +642,8 @@ class WenetPiCamera2(object):
                 self.debug_message("Capture failed! Attempting to reset camera...")
 
                 # Try and stop, then close the camera object.
+                self.session_open = False
+                self.wait_for_stop()
                 try:
                     self.cam.stop()
                 except:
@@ -485,13 +656,39 @@ class WenetPiCamera2(object):
 
                 try:
                     self.init_camera()
+                    self.open_session()
                 except:
                     self.debug_message("Error initializing camera!")
                     sleep(1)
 
                 continue
 
-            # Otherwise, proceed to post-processing step.
+            # Hand the image over to the processing stage.
+            if self.skip_stale_images:
+                self.pipeline_put_latest(capture_queue, capture_filename)
+            else:
+                self.pipeline_put(capture_queue, capture_filename)
+
+        # Loop!
+
+        self.close_session()
+
+        process_thread.join()
+        transmit_thread.join()
+
+        self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
+
+    def process_images(self, capture_queue, transmit_queue, post_process_ptr, start_id):
+        """ Pipeline stage: post-process captured images and convert them to SSDV. """
+
+        image_id = start_id
+
+        while not self.auto_capture_stop.is_set():
+            capture_filename = self.pipeline_get(capture_queue)
+            if capture_filename is None:
+                continue
+
+            # Proceed to post-processing step.
             if post_process_ptr != None:
                 try:
                     self.debug_message("Running Image Post-Processing")
@@ -501,40 +698,71 @@ class WenetPiCamera2(object):
                     self.debug_message("Image Post-Processing Failed: %s" % error_str)
 
             # SSDV'ify the image.
-            ssdv_filename = self.ssdvify(capture_filename, image_id=image_id)
+            ssdv_data = self.ssdvify(capture_filename, image_id=image_id)
 
             # Check the SSDV Conversion has completed properly. If not, continue
-            if ssdv_filename == "FAIL":
+            if ssdv_data is None:
                 sleep(1)
                 continue
 
+            self.pipeline_put(transmit_queue, ssdv_data)
+
+            # Increment image ID.
+            image_id = (image_id + 1) % 256
 
-            # Otherwise, read in the file and push into the TX buffer.
-            file_size = os.path.getsize(ssdv_filename)
+    def transmit_images(self, transmit_queue, tx):
+        """ Pipeline stage: push SSDV images into the transmit queue, one image at a time. """
+
+        while not self.auto_capture_stop.is_set():
+            ssdv_data = self.pipeline_get(transmit_queue)
+            if ssdv_data is None:
+                continue
 
             # Wait until the transmit queue is empty before pushing in packets.
             self.debug_message("Waiting for SSDV TX queue to empty.")
-            while tx.image_queue_empty() == False:
-                sleep(0.05) # Sleep for a short amount of time.
-                if self.auto_capture_running == False:
+            while not tx.wait_image_queue_empty(timeout=0.5):
+                if self.auto_capture_stop.is_set():
                     return
 
             # Inform ground station we are about to send an image.
-            self.debug_message("Transmitting %d PiCam SSDV Packets." % (file_size//256))
-
-            # Push SSDV file into transmit queue.
-            tx.queue_image_file(ssdv_filename)
+            self.debug_message("Transmitting %d PiCam SSDV Packets." % (len(ssdv_data)//256))
 
-            # Increment image ID.
-            image_id = (image_id + 1) % 256
+            # Push SSDV data into transmit queue.
+            tx.queue_image_bytes(ssdv_data)
 
             _cpu_temp = self.get_cpu_temperature()
             _cpu_freq = self.get_cpu_speed()
             self.debug_message(f"CPU State: Temperature: {_cpu_temp:.1f} degC, Frequency: {_cpu_freq} MHz")
 
-        # Loop!
-
-        self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
+    def pipeline_put(self, pipeline_queue, item):
+        """ Put an item into a pipeline queue, giving up if auto-capture is stopped. """
+        while not self.auto_capture_stop.is_set():
+            try:
+                pipeline_queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def pipeline_put_latest(self, pipeline_queue, item):
+        """ Put an item into a pipeline queue without waiting, dropping the oldest queued item if it is full.
+        Must only be used by the queue's single producer. """
+        try:
+            pipeline_queue.put_nowait(item)
+        except Full:
+            try:
+                stale_item = pipeline_queue.get_nowait()
+                self.debug_message("Processing is behind, skipping image %s" % stale_item)
+            except Empty:
+                pass
+            pipeline_queue.put_nowait(item)
+
+    def pipeline_get(self, pipeline_queue):
+        """ Get an item from a pipeline queue, returning None if none is available or auto-capture is stopped. """
+        try:
+            return pipeline_queue.get(timeout=0.5)
+        except Empty:
+            return None
 
 
     def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
@@ -554,7 +782,7 @@ class WenetPiCamera2(object):
         start_id: Starting image ID. Defaults to 0.
         """		
 
-        self.auto_capture_running = True
+        self.auto_capture_stop.clear()
 
         capture_thread = Thread(target=self.auto_capture, kwargs=dict(
             destination_directory=destination_directory,
@@ -566,7 +794,7 @@ class WenetPiCamera2(object):
         capture_thread.start()
 
     def stop(self):
-        self.auto_capture_running = False
+        self.auto_capture_stop.set()
 
     # TODO: Non-blocking image capture.
     capture_finished = False
@@ -576,9 +804,9 @@ class WenetPiCamera2(object):
     def get_cpu_temperature(self):
         """ Grab the temperature of the RPi CPU """
         try:
-            data = subprocess.check_output("/usr/bin/vcgencmd measure_temp", shell=True)
-            temp = data.decode().split('=')[1].split('\'')[0]
-            return float(temp)
+            # Reported in milli-degrees C
+            with open("/sys/class/thermal/thermal_zone0/temp", 'r') as f:
+                return int(f.read())/1000.0
         except Exception as e:
             self.debug_message("Error reading temperature - %s" % str(e))
             return -999
@@ -586,9 +814,9 @@ class WenetPiCamera2(object):
     def get_cpu_speed(self):
         """ Get the current CPU Frequency """
         try:
-            data = subprocess.check_output("cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", shell=True)
-            freq = int(data.decode().strip())/1000
-            return freq
+            # Reported in kHz
+            with open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", 'r') as f:
+                return int(f.read())/1000
         except Exception as e:
             self.debug_message("Error reading CPU Freq - %s" % str(e))
             return -1
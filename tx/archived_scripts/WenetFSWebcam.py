@@ -162,7 +162,7 @@ class WenetFSWebcam(object):
 
 		# Resize image to the desired resolution.
 		self.debug_message("Resizing image.")
-		return_code = os.system("convert %s -resize %dx%d\! webcam_temp.jpg" % (filename, self.tx_resolution[0], self.tx_resolution[1]))
+		return_code = subprocess.call(["convert", filename, "-resize", "%dx%d!" % (self.tx_resolution[0], self.tx_resolution[1]), "webcam_temp.jpg"])
 		if return_code != 0:
 			self.debug_message("Resize operation failed!")
 			return "FAIL"
@@ -171,13 +171,13 @@ class WenetFSWebcam(object):
 		file_basename = filename[:-4]
 
 		# Construct SSDV command-line.
-		ssdv_command = "ssdv -e -n -q %d -c %s -i %d webcam_temp.jpg webcam_temp.ssdv" % (quality, self.callsign, image_id)
-		print(ssdv_command)
+		ssdv_command = ["ssdv", "-e", "-n", "-q", str(quality), "-c", self.callsign, "-i", str(image_id), "webcam_temp.jpg", "webcam_temp.ssdv"]
+		print(" ".join(ssdv_command))
 		# Update debug message.
 		self.debug_message("Converting image to SSDV.")
 
 		# Run SSDV converter.
-		return_code = os.system(ssdv_command)
+		return_code = subprocess.call(ssdv_command)
 
 		if return_code != 0:
 			self.debug_message("ERROR: Could not perform SSDV Conversion.")
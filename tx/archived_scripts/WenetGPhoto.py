@@ -160,7 +160,7 @@ class WenetGPhoto(object):
 
 		# Resize image to the desired resolution.
 		self.debug_message("Resizing image.")
-		return_code = os.system("convert %s -resize %dx%d\! gphoto_temp.jpg" % (filename, resolution[0], resolution[1]))
+		return_code = subprocess.call(["convert", filename, "-resize", "%dx%d!" % (resolution[0], resolution[1]), "gphoto_temp.jpg"])
 		if return_code != 0:
 			self.debug_message("Resize operation failed!")
 			return "FAIL"
@@ -169,13 +169,13 @@ class WenetGPhoto(object):
 		file_basename = filename[:-4]
 
 		# Construct SSDV command-line.
-		ssdv_command = "ssdv -e -n -q %d -c %s -i %d gphoto_temp.jpg gphoto_temp.ssdv" % (quality, self.callsign, image_id)
-		print(ssdv_command)
+		ssdv_command = ["ssdv", "-e", "-n", "-q", str(quality), "-c", self.callsign, "-i", str(image_id), "gphoto_temp.jpg", "gphoto_temp.ssdv"]
+		print(" ".join(ssdv_command))
 		# Update debug message.
 		self.debug_message("Converting image to SSDV.")
 
 		# Run SSDV converter.
-		return_code = os.system(ssdv_command)
+		return_code = subprocess.call(ssdv_command)
 
 		if return_code != 0:
 			self.debug_message("ERROR: Could not perform SSDV Conversion.")
@@ -12,11 +12,12 @@ from picamera import mmal
 import ctypes as ct
 from time import sleep
 from threading import Thread
-import glob
-import os
-import datetime
+from queue import Queue, Empty, Full
+import io
+import subprocess
 import time
 import traceback
+from PIL import Image
 
 
 class PiCamera2(picamera.PiCamera):
@@ -45,12 +46,18 @@ class WenetPiCam(object):
 
 	"""
 
+	# Camera reset back-off after a failed capture (seconds). The delay doubles on
+	# each consecutive failure, up to the maximum, and is reset by a good capture.
+	RETRY_DELAY_MIN = 0.1
+	RETRY_DELAY_MAX = 5.0
+
 	def __init__(self,
 				callsign = "N0CALL",
 				src_resolution=(3280,2464),
 				tx_resolution=(1488,1120), 
 				num_images=1,
 				image_delay=0.5, 
+				use_video_port = None,
 				vertical_flip = False, 
 				horizontal_flip = False,
 				greyworld = False,
@@ -71,12 +78,15 @@ class WenetPiCam(object):
 			num_images: Number of images to capture in sequence when the 'capture' function is called.
 						The 'best' (largest filesize) image is selected and saved.
 			image_delay: Delay time (seconds) between each captured image.
+			use_video_port: Capture from the camera's video port, which keeps its encoder pipeline running
+						between frames, rather than the still port. This is much faster for bursts, at some cost
+						in image quality. Defaults to True only when capturing more than one image.
 
 			vertical_flip: Flip captured images vertically.
 			horizontal_flip: Flip captured images horizontally.
 							Used to correct for picam orientation.
 
-			temp_filename_prefix: prefix used for temporary files.
+			temp_filename_prefix: prefix used for temporary files. (Unused - images are captured into memory.)
 
 			debug_ptr:	'pointer' to a function which can handle debug messages.
 						This function needs to be able to accept a string.
@@ -88,6 +98,9 @@ class WenetPiCam(object):
 		self.temp_filename_prefix = temp_filename_prefix
 		self.num_images = num_images
 		self.image_delay = image_delay
+		if use_video_port is None:
+			use_video_port = num_images > 1
+		self.use_video_port = use_video_port
 		self.callsign = callsign
 		self.tx_resolution = tx_resolution
 		self.src_resolution = src_resolution
@@ -142,48 +155,56 @@ class WenetPiCam(object):
 			
 			Keyword Arguments:
 			filename:	destination filename.
+			bayer:		Append the raw bayer data to the JPEG. Only available when using the still port.
 		"""
 
 		# Attempt to capture a set of images.
-		for i in range(self.num_images):
-			self.debug_message("Capturing Image %d of %d" % (i+1,self.num_images))
-			# Wrap this in error handling in case we lose the camera for some reason.
-			try:
-				self.cam.capture("%s_%d.jpg" % (self.temp_filename_prefix,i), quality=quality, bayer=bayer)
+		# capture_continuous keeps the JPEG encoder running between frames, rather than setting it up
+		# for every capture. Frames are held in memory, and only the best one is written out.
+		pic_buffers = []
+		stream = io.BytesIO()
+		if self.use_video_port:
+			capture_args = {'use_video_port': True}
+		else:
+			capture_args = {'bayer': bayer}
+		self.debug_message("Capturing Image 1 of %d" % self.num_images)
+		# Wrap this in error handling in case we lose the camera for some reason.
+		try:
+			for _frame in self.cam.capture_continuous(stream, format='jpeg', quality=quality, **capture_args):
+				pic_buffers.append(stream.getvalue())
 				print(f"Image captured: {time.time()}")
+				if len(pic_buffers) >= self.num_images:
+					break
+				stream.seek(0)
+				stream.truncate()
 				if self.image_delay > 0:
 					sleep(self.image_delay)
-			except Exception as e: # TODO: Narrow this down...
-				self.debug_message("Capture Error: %s" % str(e))
-				# Immediately return false. Not much point continuing to try and capture images.
-				return False
+				self.debug_message("Capturing Image %d of %d" % (len(pic_buffers)+1,self.num_images))
+		except Exception as e: # TODO: Narrow this down...
+			self.debug_message("Capture Error: %s" % str(e))
+			# Immediately return false. Not much point continuing to try and capture images.
+			return False
 
 		
 		# Otherwise, continue to pick the 'best' image based on filesize.
 		self.debug_message("Choosing Best Image.")
-		pic_list = glob.glob("%s_*.jpg" % self.temp_filename_prefix)
-		pic_sizes = []
-		# Iterate through list of images and get the file sizes.
-		for pic in pic_list:
-			pic_sizes.append(os.path.getsize(pic))
-		largest_pic = pic_list[pic_sizes.index(max(pic_sizes))]
-
-		# Copy best image to target filename.
-		self.debug_message("Copying image to storage with filename %s" % filename)
-		os.system("cp %s %s" % (largest_pic, filename))
-		# Clean up temporary images.
-		os.system("rm %s_*.jpg" % self.temp_filename_prefix)
+		largest_pic = max(pic_buffers, key=len)
+
+		# Write best image to target filename.
+		self.debug_message("Saving image to storage with filename %s" % filename)
+		with open(filename, 'wb') as f:
+			f.write(largest_pic)
 
 		return True 
 
 	def ssdvify(self, filename="output.jpg", image_id=0, quality=6):
 		""" Convert a supplied JPEG image to SSDV.
-		Returns the filename of the converted SSDV image.
+		Returns the SSDV image data (bytes), or None if the conversion failed.
 
 		Keyword Arguments:
 		filename:	Source JPEG filename.
-					Output SSDV image will be saved to to a temporary file (webcam_temp.jpg) which should be
-					transmitted immediately.
+					The image is resized and converted in memory, and the resulting SSDV data
+					should be transmitted immediately.
 		image_id:	Image ID number. Must be incremented between images.
 		quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
 					6 provides good quality at decent file-sizes.
@@ -193,30 +214,38 @@ class WenetPiCam(object):
 		# Wrap image ID field if it's >255.
 		image_id = image_id % 256
 
-		# Resize image to the desired resolution.
+		# Resize image to the desired resolution, encoding the result into memory.
 		self.debug_message("Resizing image.")
-		return_code = os.system("convert %s -resize %dx%d\! picam_temp.jpg" % (filename, self.tx_resolution[0], self.tx_resolution[1]))
-		if return_code != 0:
-			self.debug_message("Resize operation failed!")
-			return "FAIL"
-
-		# Get non-extension part of filename.
-		file_basename = filename[:-4]
-
-		# Construct SSDV command-line.
-		ssdv_command = "ssdv -e -n -q %d -c %s -i %d picam_temp.jpg picam_temp.ssdv" % (quality, self.callsign, image_id)
-		print(ssdv_command)
+		try:
+			with Image.open(filename) as img:
+				# Have libjpeg decode at the smallest 1/2, 1/4 or 1/8 scale that is still at least the target size.
+				img.draft('RGB', self.tx_resolution)
+				jpeg_buffer = io.BytesIO()
+				img.resize(self.tx_resolution, Image.LANCZOS).save(jpeg_buffer, 'JPEG', quality=90)
+				jpeg_data = jpeg_buffer.getvalue()
+		except Exception as e:
+			self.debug_message("Resize operation failed! - %s" % str(e))
+			return None
+
+		# Construct SSDV command-line. With no filenames given, ssdv reads the JPEG
+		# from stdin and writes the SSDV data to stdout.
+		ssdv_command = ["ssdv", "-e", "-n", "-q", str(quality), "-c", self.callsign, "-i", str(image_id)]
+		print(" ".join(ssdv_command))
 		# Update debug message.
 		self.debug_message("Converting image to SSDV.")
 
 		# Run SSDV converter.
-		return_code = os.system(ssdv_command)
+		try:
+			result = subprocess.run(ssdv_command, input=jpeg_data, stdout=subprocess.PIPE)
+		except Exception as e:
+			self.debug_message("ERROR: Could not run SSDV converter - %s" % str(e))
+			return None
 
-		if return_code != 0:
+		if result.returncode != 0 or len(result.stdout) == 0:
 			self.debug_message("ERROR: Could not perform SSDV Conversion.")
-			return "FAIL"
+			return None
 		else:
-			return "picam_temp.ssdv"
+			return result.stdout
 
 	auto_capture_running = False
 	def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
@@ -236,24 +265,34 @@ class WenetPiCam(object):
 		delay:	An optional delay in seconds between capturing images. Defaults to 0.
 				This delay is added on top of any delays caused while waiting for the transmit queue to empty.
 		start_id: Starting image ID. Defaults to 0.
+
+		Captured images are handed to a separate processing thread (post-processing, SSDV conversion
+		and transmission), so the next image can be captured while the previous one is processed.
 		"""
 
-		image_id = start_id
+		# At most two captured images can be waiting for processing; beyond that, capture blocks.
+		capture_queue = Queue(maxsize=2)
+
+		process_thread = Thread(target=self.process_loop, args=(capture_queue, tx, post_process_ptr, start_id))
+		process_thread.start()
+
+		retry_delay = self.RETRY_DELAY_MIN
 
 		while self.auto_capture_running:
 			# Sleep before capturing next image.
 			sleep(delay)
 
 			# Grab current timestamp.
-			capture_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
+			capture_time = time.strftime("%Y%m%d-%H%M%SZ", time.gmtime())
 			capture_filename = destination_directory + "/%s_picam.jpg" % capture_time
 
 			# Attempt to capture.
 			capture_successful = self.capture(capture_filename)
 
-			# If capture was unsuccessful, try again in a little bit
+			# If capture was unsuccessful, try again in a little bit, backing off if it keeps failing.
 			if not capture_successful:
-				sleep(5)
+				sleep(retry_delay)
+				retry_delay = min(retry_delay*2, self.RETRY_DELAY_MAX)
 
 				self.debug_message("Capture failed! Attempting to reset camera...")
 
@@ -270,7 +309,33 @@ class WenetPiCam(object):
 
 				continue
 
-			# Otherwise, proceed to post-processing step.
+			retry_delay = self.RETRY_DELAY_MIN
+
+			# Hand the image over to the processing thread, waiting for space if it is behind.
+			while self.auto_capture_running:
+				try:
+					capture_queue.put(capture_filename, timeout=0.5)
+					break
+				except Full:
+					pass
+		# Loop!
+
+		process_thread.join()
+
+		self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
+
+	def process_loop(self, capture_queue, tx, post_process_ptr, start_id):
+		""" Post-process, SSDV-convert and transmit images captured by auto_capture. """
+
+		image_id = start_id
+
+		while self.auto_capture_running:
+			try:
+				capture_filename = capture_queue.get(timeout=0.5)
+			except Empty:
+				continue
+
+			# Proceed to post-processing step.
 			if post_process_ptr != None:
 				try:
 					self.debug_message("Running Image Post-Processing")
@@ -280,35 +345,27 @@ class WenetPiCam(object):
 					self.debug_message("Image Post-Processing Failed: %s" % error_str)
 
 			# SSDV'ify the image.
-			ssdv_filename = self.ssdvify(capture_filename, image_id=image_id)
+			ssdv_data = self.ssdvify(capture_filename, image_id=image_id)
 
 			# Check the SSDV Conversion has completed properly. If not, continue
-			if ssdv_filename == "FAIL":
+			if ssdv_data is None:
 				sleep(1)
 				continue
 
-
-			# Otherwise, read in the file and push into the TX buffer.
-			file_size = os.path.getsize(ssdv_filename)
-
 			# Wait until the transmit queue is empty before pushing in packets.
 			self.debug_message("Waiting for SSDV TX queue to empty.")
-			while tx.image_queue_empty() == False:
-				sleep(0.05) # Sleep for a short amount of time.
+			while not tx.wait_image_queue_empty(timeout=0.5):
 				if self.auto_capture_running == False:
 					return
 
 			# Inform ground station we are about to send an image.
-			self.debug_message("Transmitting %d PiCam SSDV Packets." % (file_size//256))
+			self.debug_message("Transmitting %d PiCam SSDV Packets." % (len(ssdv_data)//256))
 
-			# Push SSDV file into transmit queue.
-			tx.queue_image_file(ssdv_filename)
+			# Push SSDV data into transmit queue.
+			tx.queue_image_bytes(ssdv_data)
 
 			# Increment image ID.
 			image_id = (image_id + 1) % 256
-		# Loop!
-
-		self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
 
 
 	def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
@@ -25,13 +25,25 @@ import os
 import subprocess
 from BNO055 import WenetBNO055
 from threading import Thread
+from queue import Queue, Empty, Full
+from PIL import Image, ImageDraw, ImageFont
+
+# Use orjson for metadata serialisation if it's available.
+# datetime objects (e.g. the GPS datetime field) are written as ISO-format strings.
+try:
+	import orjson
+	def metadata_json(metadata):
+		return orjson.dumps(metadata)
+except ImportError:
+	def metadata_json(metadata):
+		return json.dumps(metadata, default=datetime.datetime.isoformat).encode()
 
 def get_cpu_temperature():
     """ Grab the temperature of the RPi CPU """
     try:
-        data = subprocess.check_output("/usr/bin/vcgencmd measure_temp", shell=True)
-        temp = data.decode().split('=')[1].split('\'')[0]
-        return float(temp)
+        # Reported in milli-degrees C
+        with open("/sys/class/thermal/thermal_zone0/temp", 'r') as f:
+            return int(f.read())/1000.0
     except Exception as e:
         print("Error reading temperature - %s" % str(e))
         return -999
@@ -39,9 +51,9 @@ def get_cpu_temperature():
 def get_cpu_speed():
 	""" Get the current CPU Frequency """
 	try:
-		data = subprocess.check_output("cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", shell=True)
-		freq = int(data.decode().strip())/1000
-		return freq
+		# Reported in kHz
+		with open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", 'r') as f:
+			return int(f.read())/1000
 	except Exception as e:
 		print("Error reading CPU Freq - %s" % str(e))
 		return -1
@@ -51,12 +63,24 @@ def get_cpu_speed():
 global_callsign = "VK5QI"
 #global_callsign = "SHSSP1"
 
+# GPS time epoch, used to convert GPS week/iTOW to UTC.
+GPS_EPOCH = datetime.datetime(1980,1,6,0,0,0)
+
 # Image capture directory
 image_dir = "./tx_images/"
 
 # Logo
 logo_file = None
 
+# Image overlay method - 'pillow' draws the overlay in-process, 'imagemagick' runs convert.
+overlay_method = 'pillow'
+# TrueType font used for Pillow overlays. A bare filename is searched for in the system font directories.
+overlay_font_file = "DejaVuSans.ttf"
+overlay_font_size = 30
+
+# Gamma 0.8 lookup table (equivalent to ImageMagick's -gamma 0.8), applied by the Pillow overlay.
+OVERLAY_GAMMA_LUT = [int(255*((i/255.0)**(1/0.8)) + 0.5) for i in range(256)]*3
+
 # Log files.
 text_telemetry_log = "ssp1_text.log"
 imu_log = "ssp1_imu.log"
@@ -69,10 +93,36 @@ tx = PacketTX.PacketTX(serial_port='/dev/ttyAMA0',
 					log_file=text_telemetry_log)
 tx.start_tx()
 
+# Pin the transmit thread to core 3 (ideally also isolated from other tasks with isolcpus=3 on the
+# kernel command line) with real-time priority, so camera, GPS and IMU load can't starve the UART.
+if not tx.set_tx_thread_scheduling(cpus={3}, fifo_priority=50):
+	tx.transmit_text_message("Could not set TX thread scheduling.")
+
 # Sleep for a second to let the transmitter fire up.
 time.sleep(1)
 
 
+# Image metadata is written out to the SD card by a background thread, so variable
+# SD write latency doesn't hold up the next capture.
+metadata_queue = Queue()
+
+def metadata_writer():
+	""" Serialise (filename, metadata) entries from the metadata queue, and write them to disk. """
+	while True:
+		(filename, metadata) = metadata_queue.get()
+		try:
+			data = metadata_json(metadata)
+			with open(filename, 'wb') as f:
+				f.write(data)
+		except Exception as e:
+			print("Error writing metadata file %s - %s" % (filename, str(e)))
+		metadata_queue.task_done()
+
+metadata_thread = Thread(target=metadata_writer)
+metadata_thread.daemon = True
+metadata_thread.start()
+
+
 # Initialize BNO055 Connection.
 # The main thread within this class will continually try and
 # connect to a BNO055. We can still request data from it during this
@@ -190,22 +240,77 @@ def post_process_image(filename):
 
 	overlay_string = gps_string + bno_string
 
-	# Build up our imagemagick 'convert' command line
-	overlay_str = "convert %s -gamma 0.8 -font Helvetica -pointsize 30 -gravity North " % filename 
-	overlay_str += "-strokewidth 2 -stroke '#000C' -annotate +0+5 \"%s\" " % overlay_string
-	overlay_str += "-stroke none -fill white -annotate +0+5 \"%s\" " % overlay_string
+	tx.transmit_text_message("Adding overlays to image.")
+	if overlay_method == 'imagemagick':
+		overlay_image_imagemagick(filename, overlay_string)
+	else:
+		overlay_image_pillow(filename, overlay_string)
+
+	return
+
+
+def overlay_image_pillow(filename, overlay_string):
+	""" Add the text overlay (and logo, if set) to an image in-place, using Pillow. """
+	global logo_file, tx
+
+	try:
+		img = Image.open(filename)
+		# Decode at a reduced DCT scale, no smaller than the SSDV transmit resolution.
+		img.draft('RGB', picam.tx_resolution)
+		img = img.convert('RGB').point(OVERLAY_GAMMA_LUT)
+
+		draw = ImageDraw.Draw(img)
+		try:
+			font = ImageFont.truetype(overlay_font_file, overlay_font_size)
+		except IOError:
+			font = ImageFont.load_default()
+
+		# Centre the text along the top of the image.
+		(left, top, right, bottom) = draw.textbbox((0,0), overlay_string, font=font, stroke_width=2)
+		draw.text(((img.width - (right-left))//2, 5), overlay_string, font=font,
+			fill='white', stroke_width=2, stroke_fill='black')
+
+		# Add on logo overlay in the bottom-right corner if we have been given one.
+		if logo_file is not None:
+			logo = Image.open(logo_file)
+			position = (img.width - logo.width, img.height - logo.height)
+			if logo.mode == 'RGBA':
+				img.paste(logo, position, logo)
+			else:
+				img.paste(logo, position)
+
+		img.save(filename, 'JPEG', quality=90)
+	except Exception as e:
+		tx.transmit_text_message("Image overlay failed: %s" % str(e))
+
+
+def overlay_image_imagemagick(filename, overlay_string):
+	""" Add the text overlay (and logo, if set) to an image in-place, using ImageMagick. """
+	global logo_file, tx
+
+	# Build up our imagemagick 'convert' command line.
+	# The resource limits keep ImageMagick's pixel cache in RAM, rather than silently spilling it to disk
+	# (i.e. the SD card) - with no disk allowed, it fails instead.
+	# The jpeg:size hint (which must come before the input file) lets libjpeg decode the image at a reduced
+	# DCT scale, no smaller than the SSDV transmit resolution the image is going to be resized to anyway.
+	overlay_cmd = ["convert",
+		"-limit", "memory", "256MiB", "-limit", "map", "256MiB", "-limit", "disk", "0",
+		"-define", "jpeg:size=%dx%d" % picam.tx_resolution, filename,
+		"-gamma", "0.8", "-font", "Helvetica", "-pointsize", "30", "-gravity", "North",
+		"-strokewidth", "2", "-stroke", "#000C", "-annotate", "+0+5", overlay_string,
+		"-stroke", "none", "-fill", "white", "-annotate", "+0+5", overlay_string]
 	# Add on logo overlay argument if we have been given one.
 	if logo_file is not None:
-		overlay_str += "%s -gravity SouthEast -composite " % logo_file
+		overlay_cmd += [logo_file, "-gravity", "SouthEast", "-composite"]
 
-	overlay_str += filename
+	overlay_cmd.append(filename)
 
-	print(overlay_str)
+	print(" ".join(overlay_cmd))
 
-	tx.transmit_text_message("Adding overlays to image.")
-	os.system(overlay_str)
-
-	return
+	try:
+		subprocess.run(overlay_cmd, check=True)
+	except Exception as e:
+		tx.transmit_text_message("Image overlay failed: %s" % str(e))
 
 # Try and start up the GPS rx thread.
 # Note: The UBloxGPS constructor will continuously loop until it finds a GPS unit to connect to.
@@ -244,39 +349,71 @@ while True:
 		time.sleep(2)
 		# Continue looping to ensure the error message continues to be sent...
 
-# SSDV Image ID.
-image_id = 0
+# Camera reset back-off after a failed capture (seconds). Doubles on each consecutive
+# failure, up to CAPTURE_RETRY_MAX, and is reset by a good capture.
+CAPTURE_RETRY_MIN = 0.1
+CAPTURE_RETRY_MAX = 5.0
 
-# Main 'loop'.
-while True:
-	try:
-		# Grab current timestamp for image filenames.
-		gps_data = gps.read_state()
-		if gps_time_fix:
-			# The timestamp supplied within the gps data dictionary isn't suitable for use as a filename.
-			# Do the conversion from week/iTOW/leapS to UTC time manually, and produce a suitable timestamp.
-			epoch = datetime.datetime.strptime("1980-01-06 00:00:00","%Y-%m-%d %H:%M:%S")
-			elapsed = datetime.timedelta(days=(gps_data['week']*7),seconds=(gps_data['iTOW']))
-			timestamp = epoch + elapsed - datetime.timedelta(seconds=gps_data['leapS'])
-			capture_time = timestamp.strftime("%Y%m%d-%H%M%SZ")
-		else:
-			# If we don't have valid GPS time, use system time. 
-			capture_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
+# Captured and SSDV-converted images, waiting to be transmitted.
+# Capture runs in its own thread, so the next image is captured and converted while the
+# current one is transmitted. At most two images can be waiting; beyond that, capture blocks.
+image_queue = Queue(maxsize=2)
+capture_running = True
+
+def capture_loop():
+	""" Capture, post-process and SSDV-convert images, and hand them to the main loop for transmission. """
+	global capture_running
+
+	# SSDV Image ID.
+	image_id = 0
+	capture_retry_delay = CAPTURE_RETRY_MIN
+
+	while capture_running:
+		try:
+			# Capture an instantaneous snapshot of GPS data. This is used for the image timestamp,
+			# telemetry and metadata.
+			print(f"Gathering GPS & IMU Data: {time.time()}")
+			gps_data = gps.read_state()
+			if gps_time_fix:
+				# The timestamp supplied within the gps data dictionary isn't suitable for use as a filename.
+				# Do the conversion from week/iTOW/leapS to UTC time manually, and produce a suitable timestamp.
+				timestamp = GPS_EPOCH + datetime.timedelta(days=(gps_data['week']*7),seconds=(gps_data['iTOW'] - gps_data['leapS']))
+				capture_time = timestamp.strftime("%Y%m%d-%H%M%SZ")
+			else:
+				# If we don't have valid GPS time, use system time. 
+				capture_time = time.strftime("%Y%m%d-%H%M%SZ", time.gmtime())
 
-		# Generate output filenames.
-		vis_capture_filename = image_dir + "/%s_%d_ir.jpg" % (capture_time,image_id)
-		metadata_filename = image_dir + "/%s_%d_metadata.json" % (capture_time, image_id)
+			# Generate output filenames.
+			vis_capture_filename = image_dir + "/%s_%d_ir.jpg" % (capture_time,image_id)
+			metadata_filename = image_dir + "/%s_%d_metadata.json" % (capture_time, image_id)
 
-		# Capture an instantaneous snapshot of GPS and Orientation data.
-		print(f"Gathering GPS & IMU Data: {time.time()}")
-		gps_data = gps.read_state()
-		orientation_data = bno.read_state()
+			# Capture an instantaneous snapshot of Orientation data.
+			orientation_data = bno.read_state()
 
-		# Capture picam image.
-		picam_capture_success = picam.capture(vis_capture_filename)
+			# Capture picam image.
+			picam_capture_success = picam.capture(vis_capture_filename)
+
+			if not picam_capture_success:
+				time.sleep(capture_retry_delay)
+				capture_retry_delay = min(capture_retry_delay*2, CAPTURE_RETRY_MAX)
+				tx.transmit_text_message("Capture failed! Attempting to reset camera...")
+
+				try:
+					picam.cam.close()
+				except:
+					tx.transmit_text_message("Closing camera object failed.")
+
+				try:
+					picam.init_camera()
+				except Exception as e:
+					tx.transmit_text_message("Error initializing camera - %s" % str(e))
+					time.sleep(1)
+
+				# Go back to the start of the loop and try again...
+				continue
+
+			capture_retry_delay = CAPTURE_RETRY_MIN
 
-		# If we have images, convert to SSDV.
-		if picam_capture_success:
 			# Transmit a summary of what images we were able to capture.
 			tx.transmit_text_message("Image %d Captured at %s (%s)" % (
 				image_id, 
@@ -293,55 +430,55 @@ while True:
 				tx.transmit_text_message("Image Post-Processing Failed: %s" % error_str)
 
 			# Convert image to SSDV
-			picam_ssdv_filename = picam.ssdvify(vis_capture_filename, image_id = image_id)
-		
-		else:
-			time.sleep(2)
-			tx.transmit_text_message("Capture failed! Attempting to reset camera...")
+			picam_ssdv_data = picam.ssdvify(vis_capture_filename, image_id = image_id)
 
-			try:
-				picam.cam.close()
-			except:
-				tx.transmit_text_message("Closing camera object failed.")
+			if picam_ssdv_data is None:
+				tx.transmit_text_message("Error capturing image, continuing.")
+				continue
 
-			try:
-				picam.init_camera()
-			except Exception as e:
-				tx.transmit_text_message("Error initializing camera - %s" % str(e))
-				time.sleep(1)
+			# Hand the image over for transmission, waiting for space if transmission is behind.
+			while capture_running:
+				try:
+					image_queue.put((image_id, picam_ssdv_data, gps_data, orientation_data, metadata_filename), timeout=0.5)
+					break
+				except Full:
+					pass
 
-			# Go back to the start of the loop and try again...
-			continue
+			# Increment image ID and loop!
+			image_id = (image_id + 1) % 256
+
+		except Exception as e:
+			tx.transmit_text_message("Exception in capture loop: %s" % str(e))
+			time.sleep(0.5)
 
-		if picam_ssdv_filename == "FAIL":
-			tx.transmit_text_message("Error capturing image, continuing.")
+capture_thread = Thread(target=capture_loop)
+capture_thread.daemon = True
+capture_thread.start()
+
+# Main 'loop' - transmit images as they become available.
+while True:
+	try:
+		try:
+			(image_id, picam_ssdv_data, gps_data, orientation_data, metadata_filename) = image_queue.get(timeout=0.5)
+		except Empty:
 			continue
 
 		# Wait until the transmit queue is empty before pushing in packets.
 		tx.transmit_text_message("Waiting for SSDV TX queue to empty.")
-		while tx.image_queue_empty() == False:
-			time.sleep(0.1) # Sleep for a short amount of time.
+		while not tx.wait_image_queue_empty(timeout=0.5):
+			pass
 
-		if picam_capture_success:
-			# Get file size in packets.
-			file_size = os.path.getsize(picam_ssdv_filename)/256
+		tx.transmit_text_message("Transmitting %d SSDV Packets." % (len(picam_ssdv_data)//256))
 
-			tx.transmit_text_message("Transmitting %d SSDV Packets." % file_size)
-
-			tx.queue_image_file(picam_ssdv_filename)
+		tx.queue_image_bytes(picam_ssdv_data)
 
 		# Transmit Image telemetry packet
 		tx.transmit_image_telemetry(gps_data, orientation_data, image_id, callsign=global_callsign)
 
 		# Dump all the image metadata to a json blob, and write to a file.
-		gps_data.pop('datetime') # Pop out the datetime object, as it isn't serialisable. We still have the timestamp entry...
+		# gps_data and orientation_data are snapshot copies, so they can be handed over as-is.
 		metadata = {'gps': gps_data, 'orientation': orientation_data, 'image_id': image_id}
-		f = open(metadata_filename,'w')
-		f.write(json.dumps(metadata))
-		f.close()
-
-		# Increment image ID and loop!
-		image_id = (image_id + 1) % 256
+		metadata_queue.put((metadata_filename, metadata))
 
 		_cpu_temp = get_cpu_temperature()
 		_cpu_freq = get_cpu_speed()
@@ -351,6 +488,9 @@ while True:
 	# Only really used during debugging.
 	except KeyboardInterrupt:
 		print("Closing")
+		capture_running = False
+		capture_thread.join()
+		metadata_queue.join()
 		bno.close()
 		gps.close()
 		picam.stop()
@@ -360,20 +500,3 @@ while True:
 	except Exception as e:
 		tx.transmit_text_message("Exception in main loop: %s" % str(e))
 		time.sleep(0.5)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
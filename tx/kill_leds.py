@@ -22,8 +22,15 @@ import busio
 from adafruit_pca9685 import PCA9685
 
 ADDRESS = 0x55
-LED_NUMBERS = [0,1,2,3,4,5,6,7,8]
-LED_SETTING = 0xFFFF
+# LEDs are on consecutive channels, starting from LED_FIRST.
+LED_FIRST = 0
+LED_COUNT = 9
+
+# PCA9685 registers
+LED0_ON_L = 0x06
+# LEDn_ON_L, LEDn_ON_H, LEDn_OFF_L, LEDn_OFF_H for a channel that is fully on (LEDn_ON_H bit 4 set).
+# This is what setting a duty_cycle of 0xFFFF writes.
+LED_FULL_ON = bytes([0x00, 0x10, 0x00, 0x00])
 
 # Create the I2C bus interface.
 i2c_bus = busio.I2C(SCL, SDA)
@@ -32,10 +39,12 @@ i2c_bus = busio.I2C(SCL, SDA)
 pca = PCA9685(i2c_bus,address=ADDRESS)
 
 # Set the PWM frequency to 60hz.
+# This also enables register auto-increment, which the write below relies on.
 pca.frequency = 60
 
-# LEDs are low-side switched, to set to 0xFFFF to turn off completely.
-for _led in LED_NUMBERS:
-    pca.channels[_led].duty_cycle = LED_SETTING
+# LEDs are low-side switched, to set to fully on to turn off completely.
+# Write all the LED channel registers in one I2C transaction, rather than one per register.
+with pca.i2c_device as i2c:
+    i2c.write(bytes([LED0_ON_L + 4*LED_FIRST]) + LED_FULL_ON*LED_COUNT)
 
-print("LEDs disabled.")
\ No newline at end of file
+print("LEDs disabled.")
@@ -3,6 +3,8 @@
 LDPC Encoder, using a 'RA' encoder written by Bill Cowley VK5DSP in March 2016.
 
 Compile with:
+make
+(or 'make pgo' for a profile-guided optimised build), or manually with:
 gcc -fPIC -shared -o ldpc_enc.so ldpc_enc.c
 
 
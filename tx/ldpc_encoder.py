@@ -4,6 +4,10 @@
 #   Uses ctypes to call the encode function from ldpc_enc.c
 #
 #   ldpc_enc.c needs to be compiled to a .so before this will work, with:
+#   make
+#   or, for a profile-guided optimised build:
+#   make pgo
+#   or manually with:
 #   gcc -fPIC -shared -o ldpc_enc.so ldpc_enc.c
 #
 #   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
@@ -36,7 +40,7 @@ except OSError as e:
 
 #
 #   LDPC Encoder.
-#   Accepts a 258 byte string as input, returns the LDPC parity bits.
+#   Accepts a 258 byte bytes-like object as input, returns the LDPC parity bits.
 #
 
 def ldpc_encode(payload, Nibits = 2064, Npbits = 516):
@@ -49,7 +53,7 @@ def ldpc_encode(payload, Nibits = 2064, Npbits = 516):
 
     _ldpc_enc.encode(ibits, pbits)
 
-    return np.packbits(np.array(list(pbits)).astype(np.uint8)).tobytes()
+    return np.packbits(pbits).tobytes()
 
 
 #
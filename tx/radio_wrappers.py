@@ -18,15 +18,59 @@
 #	RPi TXD: Connected to RFM98W's DIO2 pin.
 #
 import sys
+import os
 import argparse
 import logging
+import select
 import serial
+import struct
 import time
 import numpy as np
+from functools import partial
 from SX127x.LoRa import *
 from SX127x.hardware_piloragateway import HardwareInterface
 
 
+# RFM98W RegFdevMsb/RegFdevLsb contents for each supported baud rate, as (baud rate, deviation in Hz).
+# Deviation is set in steps of Fstep = 32 MHz / 2^19 (~61.03 Hz), written big-endian.
+# Unknown baud rates use the 115200 baud deviation.
+DEVIATION_REGISTERS = {
+    _baud: struct.pack('>H', int(_deviation / 61.03))
+    for (_baud, _deviation) in ((9600, 4800), (4800, 2400), (115200, 71797))
+}
+
+
+def write_fd(fd, data):
+    """
+    Write all of data to a (possibly non-blocking) file descriptor, bypassing pySerial's write wrapper.
+    Handles partial writes, and waits for the descriptor to become writable if the output buffer is full.
+    """
+    _view = memoryview(data)
+    while len(_view) > 0:
+        try:
+            _written = os.write(fd, _view)
+            _view = _view[_written:]
+        except BlockingIOError:
+            select.select([], [fd], [])
+
+
+def set_low_latency(port):
+    """
+    Enable low latency mode (ASYNC_LOW_LATENCY) on a serial port, which drops the latency timer
+    on USB-serial adaptors (16ms on FTDI devices). Requires pyserial >= 3.5 on Linux.
+    Not all drivers support this, so failures are only logged.
+    """
+    try:
+        port.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, IOError, ValueError) as e:
+        logging.debug(f"Could not enable serial low latency mode: {str(e)}")
+
+
+def discard_write(data):
+    """ Packet writer used while no serial port is open. """
+    pass
+
+
 class RFM98W_Serial(object):
     """
     RFM98W Wrapper for Wenet Transmission, using 2-FSK Direct-Asynchronous Modulation via a UART.
@@ -51,8 +95,13 @@ class RFM98W_Serial(object):
         
         self.hw = None
         self.lora = None
+        self.serial = None
+        # Function used to write out packets, bound to the serial port (or debug output) by start().
+        self.serial_write = discard_write
 
         self.tx_packet_count = 0
+        # Packet count at which the next reinitialisation is due (if reinit_count is set).
+        self.next_reinit = reinit_count
 
         self.temperature = -999
 
@@ -80,37 +129,23 @@ class RFM98W_Serial(object):
             self.shutdown()
             return
 
-        # Deviation selection. 
-        if self.baudrate == 9600:
-            deviation = 4800
-        elif self.baudrate == 4800:
-            deviation = 2400
-        else:
-            # Default deviation, for 115200 baud
-            deviation = 71797
-
         # Refer https://cdn.sparkfun.com/assets/learn_tutorials/8/0/4/RFM95_96_97_98W.pdf
         self.lora.set_register(0x01,0x00) # FSK Sleep Mode
         self.lora.set_register(0x31,0x00) # Set Continuous Transmit Mode
 
-        # Get the IC temperature
-        self.get_temperature()
-
         self.lora.set_freq(self.frequency)
         logging.info(f"RFM98W - Frequency set to: {self.frequency} MHz.")
 
-        # Set Deviation (~70 kHz). Signals ends up looking a bit wider than the RFM22B version.
-        _dev_lsbs = int(deviation / 61.03)
-        _dev_msb = _dev_lsbs >> 8
-        _dev_lsb = _dev_lsbs % 256
-        self.lora.set_register(0x04,_dev_msb)
-        self.lora.set_register(0x05,_dev_lsb)
+        # Set Deviation (~70 kHz at 115200 baud). Signals ends up looking a bit wider than the RFM22B version.
+        self.lora.set_register_burst(0x04, DEVIATION_REGISTERS.get(self.baudrate, DEVIATION_REGISTERS[115200]))
     
         # Set Transmit power
-        tx_power_lookup = {0:0x80, 1:0x80, 2:0x80, 3:0x81, 4:0x82, 5:0x83, 6:0x84, 7:0x85, 8:0x86, 9:0x87, 10:0x88, 11:0x89, 12:0x8A, 13:0x8B, 14:0x8C, 15:0x8D, 16:0x8E, 17:0x8F}
-        if self.tx_power_dbm in tx_power_lookup:
-            self.lora.set_register(0x09, tx_power_lookup[self.tx_power_dbm])
-            logging.info(f"RFM98W - TX Power set to {self.tx_power_dbm} dBm ({hex(tx_power_lookup[self.tx_power_dbm])}).")
+        # RegPaConfig: 0x80 selects the PA_BOOST output, with output power = 2 + OutputPower (low 4 bits) dBm.
+        # Powers below 2 dBm are clamped to 2 dBm.
+        if 0 <= self.tx_power_dbm <= 17:
+            _pa_config = 0x80 | max(0, self.tx_power_dbm - 2)
+            self.lora.set_register(0x09, _pa_config)
+            logging.info(f"RFM98W - TX Power set to {self.tx_power_dbm} dBm ({hex(_pa_config)}).")
         else:
             # Default to low power, 1.5mW or so
             self.lora.set_register(0x09, 0x80)
@@ -120,27 +155,41 @@ class RFM98W_Serial(object):
         self.lora.set_register(0x01,0x02) # .. via FSTX mode (where the transmit frequency actually gets set)
         self.lora.set_register(0x01,0x03) # Now we're in TX mode...
 
-        # Seems we need to briefly sleep before we can read the register correctly.
-        time.sleep(0.1)
+        # Confirm we've gone into transmit mode. The mode register takes a little while to
+        # read back correctly, so poll it for up to 200ms rather than sleeping for a fixed time.
+        _deadline = time.monotonic() + 0.2
+        while True:
+            _tx_mode = self.lora.get_register(0x01) == 0x03
+            if _tx_mode or time.monotonic() > _deadline:
+                break
+            time.sleep(0.005)
 
-        # Confirm we've gone into transmit mode.
-        if self.lora.get_register(0x01) == 0x03:
+        if _tx_mode:
             logging.info("RFM98W - Radio initialised!")
         else:
             logging.critical("RFM98W - TX Mode not set correctly!")
+
+        # Get the IC temperature, now that configuration is done. The SX127x measures
+        # its temperature on entry to FS mode, so this reading is from the FSTX transition above.
+        self.get_temperature()
         
         # Now initialise the Serial port for modulation
         if self.serial_port:
             try:
                 self.serial = serial.Serial(self.serial_port, self.baudrate)
+                set_low_latency(self.serial)
+                # Packets are written directly to the underlying file descriptor.
+                self.serial_write = partial(write_fd, self.serial.fileno())
                 logging.info(f"RFM98W - Opened Serial port {self.serial_port} for modulation.")
             except Exception as e:
                 logging.critical(f"Could not open serial port! Error: {str(e)}")
                 self.serial = None
+                self.serial_write = discard_write
 
         else:
             # If no serial port info provided, write out to a binary debug file.
             self.serial = BinaryDebug()
+            self.serial_write = self.serial.write
             logging.info("No serial port provided - using Binary Debug output (binary_debug.bin)")
 
 
@@ -168,6 +217,7 @@ class RFM98W_Serial(object):
 
         try:
             # Close the serial connection
+            self.serial_write = discard_write
             self.serial.close()
             logging.info("RFM98W - Closed Serial Port")
             self.serial = None
@@ -200,17 +250,31 @@ class RFM98W_Serial(object):
         """
         Modulate serial data, using a UART.
         """
-        if self.serial:
-            self.serial.write(packet)
+        self.serial_write(packet)
 
         # Increment transmit packet counter
         self.tx_packet_count += 1
 
         # If we have a reinitialisation count set, reinitialise the radio.
-        if self.reinit_count:
-            if self.tx_packet_count % self.reinit_count == 0:
-                logging.info(f"RFM98W - Reinitialising Radio at {self.tx_packet_count} packets.")
-                self.start()
+        if self.reinit_count and self.tx_packet_count >= self.next_reinit:
+            self.next_reinit += self.reinit_count
+            logging.info(f"RFM98W - Reinitialising Radio at {self.tx_packet_count} packets.")
+            self.start()
+
+    def transmit_packets(self, packets):
+        """
+        Modulate a list of packets, using a single write to the UART.
+        """
+        self.serial_write(b"".join(packets))
+
+        # Increment transmit packet counter
+        self.tx_packet_count += len(packets)
+
+        # If we have a reinitialisation count set, reinitialise the radio.
+        if self.reinit_count and self.tx_packet_count >= self.next_reinit:
+            self.next_reinit += self.reinit_count
+            logging.info(f"RFM98W - Reinitialising Radio at {self.tx_packet_count} packets.")
+            self.start()
 
     def get_temperature(self):
         """
@@ -240,7 +304,13 @@ class SerialOnly(object):
         self.serial_port = serial_port
         self.reinit_count = reinit_count
 
+        self.serial = None
+        # Function used to write out packets, bound to the serial port (or debug output) by start().
+        self.serial_write = discard_write
+
         self.tx_packet_count = 0
+        # Packet count at which the next reinitialisation is due (if reinit_count is set).
+        self.next_reinit = reinit_count
 
         self.start()
     
@@ -254,14 +324,19 @@ class SerialOnly(object):
         if self.serial_port:
             try:
                 self.serial = serial.Serial(self.serial_port, self.baudrate)
+                set_low_latency(self.serial)
+                # Packets are written directly to the underlying file descriptor.
+                self.serial_write = partial(write_fd, self.serial.fileno())
                 logging.info(f"SerialOnly - Opened Serial port {self.serial_port} for modulation.")
             except Exception as e:
                 logging.critical(f"SerialOnly - Could not open serial port! Error: {str(e)}")
                 self.serial = None
+                self.serial_write = discard_write
 
         else:
             # If no serial port info provided, write out to a binary debug file.
             self.serial = BinaryDebug()
+            self.serial_write = self.serial.write
             logging.info("SerialOnly - No serial port provided - using Binary Debug output (binary_debug.bin)")
 
 
@@ -272,6 +347,7 @@ class SerialOnly(object):
         """
         try:
             # Close the serial connection
+            self.serial_write = discard_write
             self.serial.close()
             logging.info("SerialOnly - Closed Serial Port")
             self.serial = None
@@ -292,17 +368,31 @@ class SerialOnly(object):
         """
         Modulate serial data, using a UART.
         """
-        if self.serial:
-            self.serial.write(packet)
+        self.serial_write(packet)
 
         # Increment transmit packet counter
         self.tx_packet_count += 1
 
         # If we have a reinitialisation count set, reinitialise the radio.
-        if self.reinit_count:
-            if self.tx_packet_count % self.reinit_count == 0:
-                logging.info(f"SerialOnly - Reinitialising Serial at {self.tx_packet_count} packets.")
-                self.start()
+        if self.reinit_count and self.tx_packet_count >= self.next_reinit:
+            self.next_reinit += self.reinit_count
+            logging.info(f"SerialOnly - Reinitialising Serial at {self.tx_packet_count} packets.")
+            self.start()
+
+    def transmit_packets(self, packets):
+        """
+        Modulate a list of packets, using a single write to the UART.
+        """
+        self.serial_write(b"".join(packets))
+
+        # Increment transmit packet counter
+        self.tx_packet_count += len(packets)
+
+        # If we have a reinitialisation count set, reinitialise the radio.
+        if self.reinit_count and self.tx_packet_count >= self.next_reinit:
+            self.next_reinit += self.reinit_count
+            logging.info(f"SerialOnly - Reinitialising Serial at {self.tx_packet_count} packets.")
+            self.start()
 
 
 class BinaryDebug(object):
@@ -311,17 +401,29 @@ class BinaryDebug(object):
     format for use with codec2-dev's fsk modulator.
     Useful for debugging, that's about it.
     """
+
+    # Output for each possible byte value: a start bit (0), 8 data bits LSB first, then a stop bit (1).
+    FRAMED_BITS = np.hstack((
+        np.zeros((256,1), dtype=np.uint8),
+        np.unpackbits(np.arange(256, dtype=np.uint8)[:,None], axis=1, bitorder='little'),
+        np.ones((256,1), dtype=np.uint8)
+        ))
+
     def __init__(self):
-        self.f = open("binary_debug.bin",'wb')
+        # Use a large write buffer, so debug output is written out in big chunks.
+        self.f = open("binary_debug.bin",'wb',buffering=1<<20)
+        # Output buffer, re-used between writes. Grown as required.
+        self.scratch = np.empty((0,10), dtype=np.uint8)
 
     def write(self,data):
-        # TODO: Add in RS232 framing
-        raw_data = np.array([],dtype=np.uint8)
-        for d in data:
-            d_array = np.unpackbits(np.fromstring(d,dtype=np.uint8))
-            raw_data = np.concatenate((raw_data,[0],d_array[::-1],[1]))
-
-        self.f.write(raw_data.astype(np.uint8).tostring())
+        data_array = np.frombuffer(data, dtype=np.uint8)
+        if len(data_array) > len(self.scratch):
+            self.scratch = np.empty((len(data_array),10), dtype=np.uint8)
+
+        # Look up the framed bits for every byte in one go, straight into the output buffer.
+        output = self.scratch[:len(data_array)]
+        np.take(self.FRAMED_BITS, data_array, axis=0, out=output)
+        self.f.write(output)
 
     def close(self):
         self.f.close()
@@ -14,8 +14,8 @@ import argparse
 import logging
 import time
 import os
-import subprocess
 import traceback
+from PIL import Image, ImageDraw, ImageFont
 from radio_wrappers import *
 
 
@@ -40,6 +40,7 @@ parser.add_argument("--exposure", type=float, default=0.0, help="Exposure compen
 parser.add_argument("--use_focus_fom", action='store_true', default=False, help="Use Focus FoM data instead of file size for image selection.")
 parser.add_argument("--num_images", type=int, default=5, help="Number of images to capture on each cycle. (Default: 5)")
 parser.add_argument("--image_delay", type=float, default=1.0, help="Delay time between each image capture. (Default: 1 second)")
+parser.add_argument("--skip_stale_images", action='store_true', default=False, help="Keep capturing while image processing is behind, and only process/transmit the freshest image.")
 parser.add_argument("-v", "--verbose", action='store_true', default=False, help="Show additional debug info.")
 args = parser.parse_args()
 
@@ -84,6 +85,14 @@ time.sleep(1)
 # Initialise a couple of global variables.
 max_altitude = 0
 system_time_set = False
+# GPS string overlaid on images, updated on each new GPS fix.
+gps_overlay_string = ""
+# Last error generating the GPS overlay string, and when it was sent to the ground. Repeated failures
+# are only sent down when the error changes, and no more than once per GPS_OVERLAY_ERROR_INTERVAL seconds.
+gps_overlay_error = None
+gps_overlay_error_time = 0
+GPS_OVERLAY_ERROR_INTERVAL = 60
+GPS_OVERLAY_FORMAT = "%s Lat: %.5f   Lon: %.5f  Alt: %dm (%dm)  Speed: H %03.1f kph  V %02.1f m/s"
 
 # Disable Systemctl NTP synchronization so that we can set the system time on first GPS lock.
 # This is necessary as NTP will refuse to sync the system time to the information we feed it via ntpshm unless
@@ -97,7 +106,7 @@ if args.gps.lower() != 'none':
 
 def handle_gps_data(gps_data):
 	""" Handle GPS data passed to us from the UBloxGPS instance """
-	global max_altitude, tx, system_time_set, picam
+	global max_altitude, tx, system_time_set, picam, gps_overlay_string, gps_overlay_error, gps_overlay_error_time
 
 	# Try and grab metadata from the camera. We send some of this in the telemetry.
 	try:
@@ -113,6 +122,33 @@ def handle_gps_data(gps_data):
 	if (gps_data['altitude'] > max_altitude) and (gps_data['gpsFix'] == 3):
 		max_altitude = gps_data['altitude']
 
+	# Construct the string which we will add onto images, so it doesn't need to be
+	# re-generated for every image.
+	try:
+		if gps_data['numSV'] < 3:
+			# If we don't have enough sats for a lock, don't display any data.
+			# TODO: Use the GPS fix status values here instead.
+			gps_overlay_string = "No GPS Lock"
+		else:
+			gps_overlay_string = GPS_OVERLAY_FORMAT % (
+				gps_data['datetime'].isoformat(' ', 'seconds')[:19],
+				gps_data['latitude'],
+				gps_data['longitude'],
+				int(gps_data['altitude']),
+				int(max_altitude),
+				gps_data['ground_speed'],
+				gps_data['ascent_rate'])
+		gps_overlay_error = None
+	except:
+		# This runs on every GPS fix, so rate-limit sending the error down (the telemetry queue is
+		# sent ahead of images), and keep overlaying the last good string.
+		error_str = traceback.format_exc()
+		logging.error("GPS Data Access Failed: %s", error_str)
+		if (error_str != gps_overlay_error) and (time.time() - gps_overlay_error_time >= GPS_OVERLAY_ERROR_INTERVAL):
+			tx.transmit_text_message("GPS Data Access Failed: %s" % error_str)
+			gps_overlay_error = error_str
+			gps_overlay_error_time = time.time()
+
 	# If we have GPS lock, set the system clock to it. (Only do this once.)
 	if (gps_data['gpsFix'] == 3) and not system_time_set:
 		dt = gps_data['datetime']
@@ -140,6 +176,8 @@ def handle_gps_data(gps_data):
 
 try:
 	if args.gps.lower() != 'none':
+		# Until we get our first fix.
+		gps_overlay_string = "No GPS Lock"
 		gps = ublox.UBloxGPS(port=args.gps, 
 			dynamic_model = ublox.DYNAMIC_MODEL_AIRBORNE1G,
 			baudrate= args.gpsbaud,
@@ -154,58 +192,91 @@ try:
 except Exception as e:
 	tx.transmit_text_message("ERROR: Could not Open GPS - %s" % str(e), repeats=5)
 	gps = None
+	gps_overlay_string = ""
+
+# Overlay resources, loaded once and re-used for every image.
+# TrueType font used for the overlay text. A bare filename is searched for in the system font directories.
+overlay_font_file = "DejaVuSans.ttf"
+overlay_font_size = 40
+try:
+	overlay_font = ImageFont.truetype(overlay_font_file, overlay_font_size)
+except IOError:
+	logging.error("Could not load overlay font %s, using default font.", overlay_font_file)
+	overlay_font = ImageFont.load_default()
+
+if args.logo != "none":
+	try:
+		overlay_logo = Image.open(args.logo)
+		overlay_logo.load()
+	except Exception as e:
+		tx.transmit_text_message("Could not load logo %s - %s" % (args.logo, str(e)))
+		overlay_logo = None
+else:
+	overlay_logo = None
+
+# Gamma 0.8 lookup table (equivalent to ImageMagick's -gamma 0.8), for all three image bands.
+OVERLAY_GAMMA_LUT = [int(255*((i/255.0)**(1/0.8)) + 0.5) for i in range(256)]*3
 
 # Define our post-processing callback function, which gets called by WenetPiCam
 # after an image has been captured.
 def post_process_image(filename):
 	""" Post-process the image, adding on Logo overlay and GPS data if requested. """
-	global gps, max_altitude, args, tx
+	global gps_overlay_string, tx
 
-	# Try and grab current GPS data snapshot
+	# Use the GPS string generated on the latest GPS fix (empty if no GPS is configured).
+	gps_string = gps_overlay_string
+
+	tx.transmit_text_message("Adding overlays to image.")
 	try:
-		if gps != None:
-			gps_state = gps.read_state()
+		overlay_image(filename, gps_string)
+	except Exception as e:
+		tx.transmit_text_message("Image Overlay operation failed! - %s" % str(e))
 
-			# Format time
-			short_time = gps_state['datetime'].strftime("%Y-%m-%d %H:%M:%S")
+	return
 
-			# Construct string which we will add onto the image.
-			if gps_state['numSV'] < 3:
-				# If we don't have enough sats for a lock, don't display any data.
-				# TODO: Use the GPS fix status values here instead.
-				gps_string = "No GPS Lock"
-			else:
-				gps_string = "%s Lat: %.5f   Lon: %.5f  Alt: %dm (%dm)  Speed: H %03.1f kph  V %02.1f m/s" % (
-					short_time,
-					gps_state['latitude'],
-					gps_state['longitude'],
-					int(gps_state['altitude']),
-					int(max_altitude),
-					gps_state['ground_speed'],
-					gps_state['ascent_rate'])
-		else:
-			gps_string = ""
-	except:
-		error_str = traceback.format_exc()
-		tx.transmit_text_message("GPS Data Access Failed: %s" % error_str)
-		gps_string = ""
 
-	# Build up our imagemagick 'convert' command line
-	overlay_str = "timeout -k 5 180 convert %s -gamma 0.8 -font Helvetica -pointsize 40 -gravity North " % filename 
-	overlay_str += "-strokewidth 2 -stroke '#000C' -annotate +0+5 \"%s\" " % gps_string
-	overlay_str += "-stroke none -fill white -annotate +0+5 \"%s\" " % gps_string
-	# Add on logo overlay argument if we have been given one.
-	if args.logo != "none":
-		overlay_str += "%s -gravity SouthEast -composite " % args.logo
+# Most recently rendered overlay text, as (string, (layer, left, top)).
+overlay_text_cache = (None, None)
 
-	overlay_str += filename
+def render_overlay_text(overlay_string):
+	""" Render the overlay text, with a black outline, onto a transparent layer cropped to the text.
+	The GPS string only changes once per fix, so the last rendered layer is cached and re-used.
+	Returns (layer, left, top), where (left, top) is the offset of the layer from the text origin.
+	"""
+	global overlay_text_cache
 
-	tx.transmit_text_message("Adding overlays to image.")
-	return_code = os.system(overlay_str)
-	if return_code != 0:
-		tx.transmit_text_message("Image Overlay operation failed! (Possible kernel Oops? Maybe set arm_freq to 700 MHz)")
+	(cached_string, cached_layer) = overlay_text_cache
+	if cached_string == overlay_string:
+		return cached_layer
 
-	return
+	(left, top, right, bottom) = overlay_font.getbbox(overlay_string, stroke_width=2)
+	layer = Image.new('RGBA', (max(1, right-left), max(1, bottom-top)), (0,0,0,0))
+	ImageDraw.Draw(layer).text((-left, -top), overlay_string, font=overlay_font,
+		fill='white', stroke_width=2, stroke_fill='black')
+
+	overlay_text_cache = (overlay_string, (layer, left, top))
+	return (layer, left, top)
+
+
+def overlay_image(filename, overlay_string):
+	""" Add the text overlay (and logo, if set) to an image in-place, using Pillow. """
+	img = Image.open(filename)
+	img = img.convert('RGB').point(OVERLAY_GAMMA_LUT)
+
+	# Centre the text along the top of the image.
+	(text_layer, left, top) = render_overlay_text(overlay_string)
+	x = (img.width - text_layer.width)//2
+	img.paste(text_layer, (x + left, 5 + top), text_layer)
+
+	# Add on logo overlay in the bottom-right corner if we have been given one.
+	if overlay_logo is not None:
+		position = (img.width - overlay_logo.width, img.height - overlay_logo.height)
+		if overlay_logo.mode == 'RGBA':
+			img.paste(overlay_logo, position, overlay_logo)
+		else:
+			img.paste(overlay_logo, position)
+
+	img.save(filename, 'JPEG', quality=90)
 
 
 # Finally, initialise the PiCam capture object.
@@ -221,7 +292,8 @@ picam = WenetPiCamera2.WenetPiCamera2(
 		lens_position=args.lensposition,
 		af_window=args.afwindow,
 		af_offset=args.afoffset,
-		use_focus_fom=args.use_focus_fom
+		use_focus_fom=args.use_focus_fom,
+		skip_stale_images=args.skip_stale_images
 		)
 # .. and start it capturing continuously.
 picam.run(destination_directory="./tx_images/", 
@@ -16,22 +16,20 @@ image_numbers = range(1,14)
 
 debug_output = False # If True, packet bits are saved to debug.bin as one char per bit.
 
-def transmit_file(filename, tx_object):
-	file_size = os.path.getsize(filename)
+def load_file(filename):
+	""" Read in a whole file. The packets are later sliced out of it without copying. """
+	with open(filename,'rb') as f:
+		return f.read()
 
-	if file_size % 256 > 0:
+def transmit_image(data, tx_object):
+	if len(data) % 256 > 0:
 		print("File size not a multiple of 256 bytes!")
 		return
 
-	print("Transmitting %d Packets." % (file_size//256))
+	print("Transmitting %d Packets." % (len(data)//256))
 
-	f = open(filename,'rb')
+	tx_object.queue_image_bytes(data)
 
-	for x in range(file_size//256):
-		data = f.read(256)
-		tx_object.tx_packet(data)
-
-	f.close()
 	print("Waiting for tx queue to empty...")
 	tx_object.wait()
 
@@ -70,6 +68,9 @@ else:
 	logging.critical("No radio type specified! Exiting")
 	sys.exit(1)
 
+# Load all the test images up-front, so only transmission happens in the TX loop.
+images = [(file_path % img, load_file(file_path % img)) for img in image_numbers]
+
 tx = PacketTX.PacketTX(
 	radio=radio,
 	udp_listener=55674)
@@ -78,10 +79,9 @@ tx.start_tx()
 
 print("TX Started. Press Ctrl-C to stop.")
 try:
-	for img in image_numbers:
-		filename = file_path % img
+	for (filename, data) in images:
 		print("\nTXing: %s" % filename)
-		transmit_file(filename,tx)
+		transmit_image(data,tx)
 	tx.close()
 except KeyboardInterrupt:
 	print("Closing...")